@@ -1,8 +1,60 @@
-from .pyscroll import BufferedRenderer, ThreadedRenderer
-from .data import TiledMapData
-from .util import *
+"""
+pyscroll loads its submodules on first use.
+
+Importing the package does not import pygame or pytmx; they are pulled in
+when one of the names below is accessed.  On python versions without module
+level __getattr__ (< 3.7), everything is imported eagerly as before.
+"""
+import sys
 
 __version__ = '2.14.2'
 __author__ = 'bitcraft'
 __author_email__ = 'leif.theden@gmail.com'
 __description__ = 'Pygame Scrolling - Python 2.7 & 3.3'
+
+# public name -> submodule that defines it
+_lazy_names = {
+    'BufferedRenderer': 'pyscroll',
+    'ThreadedRenderer': 'pyscroll',
+    'ArrayRenderer': 'headless',
+    'TiledMapData': 'data',
+    'CollisionGrid': 'collision',
+    'Minimap': 'minimap',
+    'export_map': 'export',
+    'load_pygame': 'loader',
+    'WorldData': 'world',
+    'PyscrollGroup': 'util',
+    'draw_shapes': 'util',
+}
+
+__all__ = list(_lazy_names)
+
+
+def __getattr__(name):
+    try:
+        module_name = _lazy_names[name]
+    except KeyError:
+        raise AttributeError(
+            "module {0!r} has no attribute {1!r}".format(__name__, name))
+
+    import importlib
+    module = importlib.import_module('.' + module_name, __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
+
+
+if sys.version_info < (3, 7):
+    from .pyscroll import BufferedRenderer, ThreadedRenderer
+    from .headless import ArrayRenderer
+    from .data import TiledMapData
+    from .collision import CollisionGrid
+    from .minimap import Minimap
+    from .export import export_map
+    from .loader import load_pygame
+    from .world import WorldData
+    from .util import *
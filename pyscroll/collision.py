@@ -0,0 +1,187 @@
+"""
+Grid based collision queries for map data.
+
+The grid is built once from a data class and answers which solid cells and
+objects intersect a rect, in time proportional to the cells the rect touches.
+"""
+
+from pygame import Rect
+from itertools import product, chain
+from six.moves import range
+
+__all__ = ['CollisionGrid']
+
+
+def object_rect(obj):
+    """ Return a pygame.Rect for an object with a rect, or x, y, w, h attrs
+    """
+    try:
+        return Rect(obj.rect)
+    except AttributeError:
+        return Rect(obj.x, obj.y, obj.width, obj.height)
+
+
+class CollisionGrid(object):
+    """ Collision index of solid tiles and objects on a tile grid
+
+    Solid cells are kept in a flat bytearray, and objects are kept in
+    buckets for each cell they overlap.  Queries only look at the cells that
+    the query rect touches, so the cost does not depend on how many walls
+    the map has.
+
+    All rects are in map pixel coordinates.  Cells are (x, y) tuples in
+    tiles.  Cells outside of the map are never solid.
+    """
+
+    def __init__(self, width, height, tilewidth, tileheight):
+        self.width = width
+        self.height = height
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.solid = bytearray(width * height)
+        self.buckets = dict()
+        self.object_rects = dict()
+
+    @classmethod
+    def from_data(cls, data, layers=(), tile_property=None, objects=True):
+        """ Build a grid from a data class, like TiledMapData
+
+        @param layers:
+            Tile layer numbers where every non-empty tile is solid.
+
+        @param tile_property:
+            If set, tiles on any visible tile layer are solid when they have
+            this property set to a true value.  The data class must have a
+            get_tile_properties method.
+
+        @param objects:
+            If True, the objects of all visible object layers are added.
+            Otherwise, it may be an iterable of objects to add, such as the
+            objects of a hidden layer used only for collisions.
+        """
+        grid = cls(data.width, data.height, data.tilewidth, data.tileheight)
+        cells = list(product(range(data.width), range(data.height)))
+
+        for l in layers:
+            for x, y in cells:
+                if data.get_tile_image((x, y, l)):
+                    grid.set_solid(x, y)
+
+        if tile_property is not None:
+            for l in data.visible_tile_layers:
+                for x, y in cells:
+                    props = data.get_tile_properties((x, y, l))
+                    if props and props.get(tile_property):
+                        grid.set_solid(x, y)
+
+        if objects is True:
+            objects = chain.from_iterable(data.visible_object_layers)
+
+        if objects:
+            for obj in objects:
+                grid.add_object(obj)
+
+        return grid
+
+    def cells_in_rect(self, rect):
+        """ Return the cells touched by a rect, clipped to the map
+        """
+        tw, th = self.tilewidth, self.tileheight
+        left = max(rect.left // tw, 0)
+        top = max(rect.top // th, 0)
+        right = min(max(rect.right - 1, rect.left) // tw, self.width - 1)
+        bottom = min(max(rect.bottom - 1, rect.top) // th, self.height - 1)
+        return product(range(left, right + 1), range(top, bottom + 1))
+
+    def set_solid(self, x, y, solid=True):
+        self.solid[y * self.width + x] = 1 if solid else 0
+
+    def is_solid(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return bool(self.solid[y * self.width + x])
+        return False
+
+    def add_object(self, obj):
+        """ Add an object with a rect, or x, y, width and height attributes
+
+        The rect is read once; call move_object if the object moves.
+        """
+        rect = object_rect(obj)
+        self.object_rects[obj] = rect
+        buckets = self.buckets
+        for cell in self.cells_in_rect(rect):
+            try:
+                buckets[cell].append(obj)
+            except KeyError:
+                buckets[cell] = [obj]
+
+    def remove_object(self, obj):
+        rect = self.object_rects.pop(obj)
+        buckets = self.buckets
+        for cell in self.cells_in_rect(rect):
+            bucket = buckets[cell]
+            bucket.remove(obj)
+            if not bucket:
+                del buckets[cell]
+
+    def move_object(self, obj):
+        """ Update the cells of an object after it has moved
+        """
+        self.remove_object(obj)
+        self.add_object(obj)
+
+    def hit_cells(self, rect):
+        """ Return list of solid cells that intersect rect
+        """
+        solid = self.solid
+        width = self.width
+        return [(x, y) for x, y in self.cells_in_rect(rect)
+                if solid[y * width + x]]
+
+    def hit_objects(self, rect):
+        """ Return list of objects that intersect rect
+        """
+        buckets = self.buckets
+        object_rects = self.object_rects
+        colliderect = rect.colliderect
+        seen = set()
+        hits = list()
+        for cell in self.cells_in_rect(rect):
+            for obj in buckets.get(cell, ()):
+                if obj not in seen:
+                    seen.add(obj)
+                    if colliderect(object_rects[obj]):
+                        hits.append(obj)
+        return hits
+
+    def collide(self, rect):
+        """ Return True if rect intersects any solid cell or object
+        """
+        solid = self.solid
+        width = self.width
+        buckets = self.buckets
+        object_rects = self.object_rects
+        colliderect = rect.colliderect
+        for x, y in self.cells_in_rect(rect):
+            if solid[y * width + x]:
+                return True
+            for obj in buckets.get((x, y), ()):
+                if colliderect(object_rects[obj]):
+                    return True
+        return False
+
+    def collide_many(self, rects):
+        """ Return list of the indices of rects that hit something
+
+        This is the bulk version of collide, for checking many sprites at
+        once.
+        """
+        collide = self.collide
+        return [i for i, rect in enumerate(rects) if collide(rect)]
+
+    def query_many(self, rects):
+        """ Return list of (cells, objects) tuples, one for each rect
+        """
+        hit_cells = self.hit_cells
+        hit_objects = self.hit_objects
+        return [(hit_cells(rect), hit_objects(rect)) for rect in rects]
@@ -1,19 +1,336 @@
 """
 This file contains two data classes for use with pytmx.
+
+pytmx is not imported until a data class is used, and the version of pytmx
+is checked when the first TiledMapData is created.
 """
 
-import sys
-import pytmx
+__all__ = ['TiledMapData', 'TILE_EMPTY', 'TILE_PARTIAL', 'TILE_OPAQUE']
+
+# how much of the tiles under a tile can be seen
+TILE_EMPTY = 0
+TILE_PARTIAL = 1
+TILE_OPAQUE = 2
+
+# None until the installed pytmx version has been checked
+_legacy_api = None
+
+
+def use_legacy_api():
+    """ Return True if the installed pytmx requires the legacy (2.x) api
+
+    The version is only checked once, the first time this is called.
+    """
+    global _legacy_api
+    if _legacy_api is None:
+        import logging
+        import pytmx
+
+        try:
+            version = getattr(pytmx, "__version__", (0, 0, 0))
+            _legacy_api = version < (2, 18, 0)
+        except TypeError:
+            _legacy_api = True
+
+        if _legacy_api:
+            logging.getLogger(__name__).debug(
+                'pyscroll is using the legacy pytmx api')
+
+    return _legacy_api
+
+
+def get_image_opacity(image):
+    """ Return TILE_EMPTY, TILE_PARTIAL or TILE_OPAQUE for a surface
+    """
+    import pygame
+
+    if not image:
+        return TILE_EMPTY
+
+    alpha = image.get_alpha()
+    if image.get_flags() & pygame.SRCALPHA:
+        # count pixels that are not completely opaque
+        if pygame.mask.from_surface(image, 0).count() == 0:
+            return TILE_EMPTY
+        if alpha is not None and alpha < 255:
+            return TILE_PARTIAL
+        w, h = image.get_size()
+        if pygame.mask.from_surface(image, 254).count() < w * h:
+            return TILE_PARTIAL
+        return TILE_OPAQUE
+
+    if alpha is not None and alpha < 255:
+        return TILE_EMPTY if alpha == 0 else TILE_PARTIAL
+
+    if image.get_colorkey() is not None:
+        w, h = image.get_size()
+        count = pygame.mask.from_surface(image).count()
+        if count == 0:
+            return TILE_EMPTY
+        if count < w * h:
+            return TILE_PARTIAL
+
+    return TILE_OPAQUE
+
+
+def map_structure(tmx):
+    """ Return what must be the same in two maps to compare them by cell
+    """
+    tilesets = [(ts.name, ts.firstgid, ts.source, ts.tilewidth,
+                 ts.tileheight) for ts in tmx.tilesets]
+    layers = [(type(layer).__name__, layer.name) for layer in tmx.layers]
+    return (tmx.width, tmx.height, tmx.tilewidth, tmx.tileheight,
+            tilesets, layers)
+
+
+def tiled_gids(tmx):
+    """ Return dict of pytmx gid: (Tiled gid, flags)
+
+    pytmx numbers tiles in the order they are loaded, so the same tile may
+    have a different gid in two versions of a map.
+    """
+    gids = dict()
+    for key, value in tmx.imagemap.items():
+        gid = value[0] if isinstance(value, tuple) else value
+        gids[gid] = key
+    return gids
+
+
+def diff_tiles(old, new):
+    """ Return list of (x, y, layer) positions where the tiles differ
+
+    The maps must have the same structure, see map_structure.
+    """
+    import pytmx
+
+    old_gids = tiled_gids(old)
+    new_gids = tiled_gids(new)
+    changed = list()
+    for l, (a, b) in enumerate(zip(old.layers, new.layers)):
+        if not isinstance(a, pytmx.TiledTileLayer):
+            continue
+        if a.visible != b.visible:
+            changed.extend((x, y, l) for y in range(new.height)
+                           for x in range(new.width))
+            continue
+        for y, (old_row, new_row) in enumerate(zip(a.data, b.data)):
+            for x, (i, j) in enumerate(zip(old_row, new_row)):
+                if old_gids.get(i) != new_gids.get(j):
+                    changed.append((x, y, l))
+    return changed
+
+
+def diff_objects(old, new):
+    """ Return list of (x, y, layer) positions of cells under changed objects
+
+    Cells under both the old and the new place of an object are included,
+    and layer is the number of the object layer.
+    """
+    import pytmx
+
+    tw, th = new.tilewidth, new.tileheight
+    old_gids = tiled_gids(old)
+    new_gids = tiled_gids(new)
+    changed = set()
+    for l, (a, b) in enumerate(zip(old.layers, new.layers)):
+        if not isinstance(a, pytmx.TiledObjectGroup):
+            continue
+        old_objects = dict((o.id, o) for o in a)
+        new_objects = dict((o.id, o) for o in b)
+        for key in set(old_objects) | set(new_objects):
+            o = old_objects.get(key)
+            n = new_objects.get(key)
+            if (o is not None and n is not None and a.visible == b.visible and
+                    object_key(o, old_gids) == object_key(n, new_gids)):
+                continue
+            for obj in (o, n):
+                if obj is not None:
+                    left, top, right, bottom = object_bounds(obj)
+                    changed.update(
+                        (x, y, l)
+                        for y in range(max(0, int(top // th)),
+                                       min(new.height, int(bottom // th) + 1))
+                        for x in range(max(0, int(left // tw)),
+                                       min(new.width, int(right // tw) + 1)))
+    return sorted(changed)
+
 
-__all__ = ['TiledMapData']
+def object_key(obj, gids):
+    """ Return the attributes of an object that change how it is drawn
+    """
+    return (obj.x, obj.y, obj.width, obj.height, obj.visible,
+            getattr(obj, 'rotation', 0), gids.get(obj.gid),
+            getattr(obj, 'points', None), getattr(obj, 'closed', None),
+            getattr(obj, 'color', None), getattr(obj, 'texture', None))
+
+
+def object_bounds(obj):
+    """ Return left, top, right, bottom of an object, with room for lines
+    """
+    points = getattr(obj, 'points', None)
+    if points:
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        left, top, right, bottom = min(xs), min(ys), max(xs), max(ys)
+    else:
+        left, top = obj.x, obj.y
+        right, bottom = obj.x + obj.width, obj.y + obj.height
+    return left - 2, top - 2, right + 2, bottom + 2
 
 
 class TiledMapData(object):
     """ For PyTMX 3.x and 6.x
+
+    Creating a TiledMapData with a pytmx older than 2.18 will return a
+    LegacyTiledMapData instead.
+
+    If deduplicate is True, the tile images of the map are hashed when the
+    data is created.  Tiles that look the same will share one surface, and
+    tiles that are fully transparent are removed, so they are never blitted.
+    The pytmx map is not changed: the data keeps the surfaces that are
+    replaced in replaced_images.  Images that were hashed before are not
+    hashed again when the map is reloaded.
+
+    The opacity of every tile image is found when the data is created, so
+    the renderer can skip tiles that are covered by opaque tiles.
+
+    Tile animations are also read when the data is created: animations maps
+    each animated gid to a tuple of (frame gid, duration in ms) pairs, and
+    animated_tiles maps each (x, y, layer) position of an animated tile to
+    its gid.
+
+    Tiles can be changed with set_tile and set_tiles, or by reloading the
+    map with reload.  Callables in tile_listeners are called with the
+    positions that changed, which is how renderers and minimaps that use the
+    data know what to draw again.
     """
 
-    def __init__(self, tmx):
+    def __new__(cls, *args, **kwargs):
+        if cls is TiledMapData and use_legacy_api():
+            cls = LegacyTiledMapData
+        return object.__new__(cls)
+
+    def __init__(self, tmx, deduplicate=False):
+        self.deduplicate = deduplicate
+        self.tile_listeners = list()
+        self.replaced_images = dict()
+        self._image_keys = dict()
+        self.set_tmx(tmx)
+
+    def set_tmx(self, tmx):
+        """ Use a pytmx map, and find the opacity and animations of tiles
+        """
         self.tmx = tmx
+        self.image_opacity = dict()
+        self.replaced_images = dict()
+        if self.deduplicate:
+            self.deduplicate_images()
+
+        replaced = self.replaced_images
+        for image in tmx.images:
+            image = replaced.get(image, image)
+            if image:
+                self.image_opacity[image] = get_image_opacity(image)
+
+        self.animations = dict()
+        self.animated_tiles = dict()
+        self.find_animated_tiles()
+
+    def reload(self, tmx=None):
+        """ Replace the map with a new version of it, like an edited file
+
+        If tmx is None, the file of the map is loaded again with
+        pyscroll.load_pygame, so tiles that are still used keep their
+        surfaces.  Tile layers and objects of the new map are compared with
+        the old one, and the listeners are called once with the positions of
+        the cells that changed.  If the size of the map, the layers or the
+        tilesets changed, every cell is changed.
+
+        Returns the list of changed positions.
+        """
+        if tmx is None:
+            from .loader import load_pygame
+            tmx = load_pygame(self.tmx.filename)
+
+        old = self.tmx
+        if map_structure(old) == map_structure(tmx):
+            changed = diff_tiles(old, tmx) + diff_objects(old, tmx)
+        else:
+            changed = [(x, y, l) for l in range(len(tmx.layers))
+                       for y in range(tmx.height) for x in range(tmx.width)]
+
+        self.set_tmx(tmx)
+        if changed:
+            for listener in list(self.tile_listeners):
+                listener(changed)
+        return changed
+
+    def find_animated_tiles(self):
+        """ Collect animated gids and the positions they are used at
+        """
+        import pytmx
+
+        properties = getattr(self.tmx, 'tile_properties', dict())
+        animations = dict()
+        for gid, props in properties.items():
+            frames = props.get('frames') if props else None
+            if frames:
+                animations[gid] = tuple((f.gid, f.duration) for f in frames)
+
+        animated_tiles = dict()
+        if animations:
+            for l, layer in enumerate(self.tmx.layers):
+                if isinstance(layer, pytmx.TiledTileLayer):
+                    for x, y, gid in layer.iter_data():
+                        if gid in animations:
+                            animated_tiles[(x, y, l)] = gid
+
+        self.animations = animations
+        self.animated_tiles = animated_tiles
+
+    def deduplicate_images(self):
+        """ Share identical tile images and remove transparent ones
+
+        Fills replaced_images with surface: shared surface or None, and
+        returns the number of images that were replaced or removed.
+        """
+        import hashlib
+        import pygame
+
+        tostring = pygame.image.tostring
+        from_surface = pygame.mask.from_surface
+        old_keys = self._image_keys
+        keys = dict()
+        seen = dict()
+        replaced = dict()
+
+        for image in self.tmx.images:
+            if not isinstance(image, pygame.Surface) or image in keys:
+                continue
+
+            try:
+                key = old_keys[image]
+            except KeyError:
+                # nothing is drawn if no pixel has any alpha
+                if from_surface(image, 0).count() == 0:
+                    key = None
+                else:
+                    key = (image.get_size(), image.get_colorkey(),
+                           image.get_alpha(),
+                           image.get_flags() & pygame.SRCALPHA,
+                           hashlib.sha1(tostring(image, 'RGBA')).digest())
+            keys[image] = key
+
+            if key is None:
+                replaced[image] = None
+            elif key in seen:
+                replaced[image] = seen[key]
+            else:
+                seen[key] = image
+
+        self._image_keys = keys
+        self.replaced_images = replaced
+        return len(replaced)
 
     @property
     def tilewidth(self):
@@ -41,6 +358,7 @@ class TiledMapData(object):
 
     @property
     def visible_object_layers(self):
+        import pytmx
         return (layer for layer in self.tmx.visible_layers
                 if isinstance(layer, pytmx.TiledObjectGroup))
 
@@ -51,18 +369,96 @@ class TiledMapData(object):
         position is x, y, layer tuple
         """
         x, y, l = position
-        return self.tmx.get_tile_image(x, y, l)
+        image = self.tmx.get_tile_image(x, y, l)
+        if self.replaced_images:
+            return self.replaced_images.get(image, image)
+        return image
+
+    def get_tile_properties(self, position):
+        """ Return dict of tile properties for this position, or None
+
+        position is x, y, layer tuple
+        """
+        x, y, l = position
+        return self.tmx.get_tile_properties(x, y, l)
+
+    def get_tile_opacity(self, position):
+        """ Return TILE_EMPTY, TILE_PARTIAL or TILE_OPAQUE for this position
+
+        position is x, y, layer tuple
+        """
+        try:
+            image = self.get_tile_image(position)
+        except ValueError:
+            return TILE_EMPTY
+
+        if not image:
+            return TILE_EMPTY
+
+        try:
+            return self.image_opacity[image]
+        except KeyError:
+            opacity = self.image_opacity[image] = get_image_opacity(image)
+            return opacity
 
     def get_tile_image_by_gid(self, gid):
         """ Return surface for a gid (experimental)
         """
-        return self.tmx.get_tile_image_by_gid(gid)
+        image = self.tmx.get_tile_image_by_gid(gid)
+        if self.replaced_images:
+            return self.replaced_images.get(image, image)
+        return image
+
+    def set_tile(self, x, y, layer, gid):
+        """ Change the tile at a position, see set_tiles
+        """
+        return self.set_tiles([(x, y, layer, gid)])
+
+    def set_tiles(self, tiles):
+        """ Change many tiles at once
+
+        tiles is an iterable of (x, y, layer, gid) tuples.  gid is a pytmx gid,
+        like the ones get_tile_image_by_gid takes, and 0 removes the tile.
+
+        The listeners are called once with the list of (x, y, layer)
+        positions that really changed, and that list is returned.
+        """
+        animations = self.animations
+        animated = self.animated_tiles
+        changed = list()
+        for x, y, l, gid in tiles:
+            row = self.get_layer_data(l)[y]
+            if row[x] == gid:
+                continue
+            row[x] = gid
+            position = (x, y, l)
+            if gid in animations:
+                animated[position] = gid
+            else:
+                animated.pop(position, None)
+            changed.append(position)
+
+        if changed:
+            for listener in list(self.tile_listeners):
+                listener(changed)
+        return changed
+
+    def get_layer_data(self, layer):
+        """ Return the rows of gids of a tile layer
+        """
+        return self.tmx.layers[layer].data
 
 
 class LegacyTiledMapData(TiledMapData):
     """ For PyTMX 2.x series
     """
 
+    def find_animated_tiles(self):
+        """ PyTMX 2.x does not load tile animations
+        """
+        self.animations = dict()
+        self.animated_tiles = dict()
+
     @property
     def visible_layers(self):
         return (int(i) for (i, l) in enumerate(self.tmx.all_layers)
@@ -83,18 +479,28 @@ class LegacyTiledMapData(TiledMapData):
         position is x, y, layer tuple
         """
         x, y, l = position
-        return self.tmx.getTileImage(x, y, l)
+        image = self.tmx.getTileImage(x, y, l)
+        if self.replaced_images:
+            return self.replaced_images.get(image, image)
+        return image
+
+    def get_tile_properties(self, position):
+        """ Return dict of tile properties for this position, or None
+
+        position is x, y, layer tuple
+        """
+        return self.tmx.getTileProperties(position)
 
     def get_tile_image_by_gid(self, gid):
         """ Return surface for a gid (experimental)
         """
-        return self.tmx.getTileImageByGid(gid)
+        image = self.tmx.getTileImageByGid(gid)
+        if self.replaced_images:
+            return self.replaced_images.get(image, image)
+        return image
 
+    def get_layer_data(self, layer):
+        """ Return the rows of gids of a tile layer
+        """
+        return self.tmx.tilelayers[layer].data
 
-try:
-    if getattr(pytmx, "__version__", (0, 0, 0)) < (2, 18, 0):
-        sys.stderr.write('pyscroll is using the legacy pytmx api\n')
-        TiledMapData = LegacyTiledMapData
-except (AttributeError, TypeError):
-    sys.stderr.write('pyscroll is using the legacy pytmx api\n')
-    TiledMapData = LegacyTiledMapData
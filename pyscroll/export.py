@@ -0,0 +1,221 @@
+"""
+Export a whole map to a PNG image, without holding the whole image in memory.
+
+The map is rendered in strips of tile rows with a BufferedRenderer, so tiles,
+static images and objects are drawn the same way they are on the screen.
+Each strip is compressed and written to the file before the next one is
+rendered, so memory use depends on the width of the map and the strip size,
+not on the size of the map.
+"""
+
+import struct
+import zlib
+from six.moves import range
+
+__all__ = ['export_map']
+
+# per process data used by the workers of a process pool
+_worker_data = None
+
+
+class PNGWriter(object):
+    """ Write an RGB PNG file one group of rows at a time
+    """
+
+    def __init__(self, fileobj, width, height):
+        self.fileobj = fileobj
+        self.width = width
+        self.compressor = zlib.compressobj()
+        fileobj.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                              8, 2, 0, 0, 0))
+
+    def write_chunk(self, kind, payload):
+        crc = zlib.crc32(kind + payload) & 0xffffffff
+        self.fileobj.write(struct.pack('>I', len(payload)) + kind + payload +
+                           struct.pack('>I', crc))
+
+    def write_rows(self, pixels):
+        """ Write rows of RGB pixels, packed with no padding
+        """
+        stride = self.width * 3
+        rows = (b'\x00' + pixels[i:i + stride]
+                for i in range(0, len(pixels), stride))
+        compressed = self.compressor.compress(b''.join(rows))
+        if compressed:
+            self.write_chunk(b'IDAT', compressed)
+
+    def close(self):
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+
+
+def tile_overhang(data):
+    """ Return how many (columns, rows) tiles reach past their own cell
+
+    Tiles are blitted at the top left of their cell, so tiles that are larger
+    than the cells of the map cover cells to the right and below.  If the
+    tile images are not known, one cell is assumed.
+    """
+    images = getattr(getattr(data, 'tmx', None), 'images', None)
+    if images is None:
+        return 1, 1
+
+    tw = data.tilewidth
+    th = data.tileheight
+    columns = rows = 0
+    for image in images:
+        if image:
+            w, h = image.get_size()
+            columns = max(columns, (w - 1) // tw)
+            rows = max(rows, (h - 1) // th)
+    return columns, rows
+
+
+class StripRenderer(object):
+    """ Render rows of tiles of a map to RGB bytes
+
+    Strips are rendered in chunks of columns, so the surface that is used
+    never gets larger than chunk_columns x strip_rows tiles, plus the cells
+    that large tiles from the left and above reach into.  Those are rendered
+    with the chunk and cropped, so the strips join without seams.
+    """
+
+    def __init__(self, data, strip_rows, chunk_columns, background):
+        import pygame
+        from .pyscroll import BufferedRenderer
+
+        self.data = data
+        self.strip_rows = strip_rows
+        self.chunk_columns = min(chunk_columns, data.width)
+        self.background = background
+        self.overhang = tile_overhang(data)
+        size = ((self.chunk_columns + self.overhang[0]) * data.tilewidth,
+                (strip_rows + self.overhang[1]) * data.tileheight)
+        self.renderer = BufferedRenderer(data, size, padding=0,
+                                         prerender_limit=0)
+        self.tostring = pygame.image.tostring
+
+    def render(self, top):
+        """ Return RGB bytes for the strip that starts at tile row top
+        """
+        data = self.data
+        tw = data.tilewidth
+        th = data.tileheight
+        renderer = self.renderer
+        buffer = renderer.buffer
+        rows = min(self.strip_rows, data.height - top)
+        height = rows * th
+        above = min(self.overhang[1], top)
+
+        chunks = list()
+        for left in range(0, data.width, self.chunk_columns):
+            columns = min(self.chunk_columns, data.width - left)
+            before = min(self.overhang[0], left)
+            renderer.view.topleft = (left - before, top - above)
+            buffer.fill(self.background)
+            renderer.redraw()
+            area = buffer.subsurface((before * tw, above * th,
+                                      columns * tw, height))
+            chunks.append((columns * tw * 3, self.tostring(area, 'RGB')))
+
+        if len(chunks) == 1:
+            return chunks[0][1]
+
+        # join the chunks row by row
+        lines = list()
+        for y in range(height):
+            for stride, pixels in chunks:
+                lines.append(pixels[y * stride:(y + 1) * stride])
+        return b''.join(lines)
+
+
+def _init_worker(loader, strip_rows, chunk_columns, background):
+    from .loader import _reset_sigterm
+    global _worker_data
+    _worker_data = StripRenderer(loader(), strip_rows, chunk_columns,
+                                 background)
+    _reset_sigterm()
+
+
+def _render_worker_strip(top):
+    return _worker_data.render(top)
+
+
+def export_map(data, filename, strip_rows=4, chunk_columns=64,
+               background=(0, 0, 0), processes=None, loader=None):
+    """ Render the whole map to a PNG file
+
+    @param data:
+        Data class of the map, like TiledMapData.
+
+    @param filename:
+        Path or binary file object to write to.
+
+    @param strip_rows:
+        Number of tile rows to render and write at a time.
+
+    @param chunk_columns:
+        Number of tile columns to render at a time.
+
+    @param processes:
+        If set, strips are rendered by a pool of this many processes.
+        Surfaces cannot be sent to other processes, so a loader must be
+        given as well.
+
+    @param loader:
+        Picklable callable that returns the data class in a worker
+        process, for example a module level function that loads the map.
+    """
+    tw = data.tilewidth
+    th = data.tileheight
+    tops = range(0, data.height, strip_rows)
+
+    if hasattr(filename, 'write'):
+        fileobj = filename
+        close = False
+    else:
+        fileobj = open(filename, 'wb')
+        close = True
+
+    try:
+        writer = PNGWriter(fileobj, data.width * tw, data.height * th)
+
+        if processes:
+            if loader is None:
+                raise ValueError('a loader is required to use processes')
+            _export_with_pool(writer, tops, processes, loader,
+                              (strip_rows, chunk_columns, background))
+        else:
+            strips = StripRenderer(data, strip_rows, chunk_columns,
+                                   background)
+            for top in tops:
+                writer.write_rows(strips.render(top))
+
+        writer.close()
+    finally:
+        if close:
+            fileobj.close()
+
+
+def _export_with_pool(writer, tops, processes, loader, options):
+    """ Render strips in a process pool and write them in order
+
+    Only a few strips are in flight at once, so finished strips cannot pile
+    up in memory if writing is slower than rendering.
+    """
+    import multiprocessing
+    from collections import deque
+
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (loader,) + options)
+    try:
+        pending = deque()
+        for top in tops:
+            pending.append(pool.apply_async(_render_worker_strip, (top,)))
+            if len(pending) >= processes * 2:
+                writer.write_rows(pending.popleft().get())
+        while pending:
+            writer.write_rows(pending.popleft().get())
+    finally:
+        pool.terminate()
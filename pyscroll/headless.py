@@ -0,0 +1,397 @@
+"""
+Renderer that draws tiles with numpy instead of one blit per tile.
+
+Tiles are copied into arrays the first time they are drawn, and the atlas
+index of every cell of the map is kept in an array for each layer, so a
+batch of tiles is drawn with a few vectorized gathers and blends, without
+looking up tiles again.  This is meant for servers that render frames
+without a display, like thumbnails and replays.
+
+The frames are the same, pixel for pixel, as those of BufferedRenderer.
+Alpha is blended with the same integer math as pygame.  Tiles with a
+surface alpha, or that are not the size of a cell, are still blitted with
+pygame, because their blending cannot be matched exactly.
+
+This module requires numpy.
+"""
+
+import pygame
+import weakref
+from itertools import chain
+from .pyscroll import BufferedRenderer
+
+__all__ = ['ArrayRenderer']
+
+# how a tile in the atlas is drawn
+TILE_NONE = 0      # nothing to draw
+TILE_COPY = 1      # opaque, copied over the cell
+TILE_BLEND = 2     # blended with per-pixel alpha, or colorkey as alpha
+TILE_PYGAME = 3    # blitted with pygame
+TILE_OVERSIZE = 4  # not the size of a cell, the whole batch uses pygame
+
+
+class ArrayRenderer(BufferedRenderer):
+    """ BufferedRenderer that draws tiles into the buffers with numpy
+
+    Use it like BufferedRenderer.  draw_array returns a frame as a numpy
+    array, for rendering without a display.
+
+    The atlas indexes of the cells take 4 bytes per cell of each tile layer
+    that is drawn.  The buffers must be 32 bit, otherwise tiles are blitted
+    with pygame.  The atlas holds weak references to the tiles, and is made
+    again when most of its tiles have been freed, like when the maps of a
+    WorldData are unloaded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._frame = None
+        self._reset_atlas()
+        BufferedRenderer.__init__(self, *args, **kwargs)
+
+    def _reset_atlas(self):
+        """ Forget the tile arrays and the atlas indexes of all cells
+        """
+        self._atlas = weakref.WeakKeyDictionary()
+        self._atlas_tiles = [(TILE_NONE, None, None)]
+        self._atlas_arrays = None
+        self._atlas_format = None
+        self._layer_index = dict()
+        self._layer_index_size = None
+
+    def set_animations(self, animations, animated_tiles):
+        # animated cells are not kept in the layer indexes
+        self._layer_index = dict()
+        BufferedRenderer.set_animations(self, animations, animated_tiles)
+
+    def set_data(self, data):
+        self._reset_atlas()
+        BufferedRenderer.set_data(self, data)
+
+    def invalidate_tiles(self, positions):
+        positions = list(positions)
+        layer_index = self._layer_index
+        if layer_index:
+            width, height = self._layer_index_size
+            for x, y, l in positions:
+                index = layer_index.get(l)
+                if index is not None and 0 <= x < width and 0 <= y < height:
+                    index[y, x] = -1
+
+        BufferedRenderer.invalidate_tiles(self, positions)
+
+    def draw_array(self, surfaces=None):
+        """ Draw the map and return the frame as an array
+
+        The array has a shape of (height, width, 3), in RGB order.  surfaces
+        are drawn with the map, like in draw.
+        """
+        import numpy
+
+        frame = self._frame
+        if frame is None or frame.get_size() != tuple(self.size):
+            frame = self._frame = pygame.Surface(self.size, 0, self.buffer)
+        frame.fill((0, 0, 0))
+        self.draw(frame, frame.get_rect(), surfaces)
+        pixels = bytearray(pygame.image.tostring(frame, 'RGB'))
+        width, height = self.size
+        return numpy.frombuffer(pixels, numpy.uint8).reshape(height, width, 3)
+
+    def blit_tiles(self, iterator):
+        """ Draw (x, y, layer) tuples into the buffers with numpy
+
+        Cells are cleared like BufferedRenderer.blit_tiles.  Tiles of cells
+        that are not wholly in the buffer, that have static images, or have
+        tiles that need pygame are blitted with pygame.
+        """
+        import numpy
+
+        tiles = list(iterator)
+        if not tiles:
+            return
+
+        if self.colorkey or self._layer_buffers:
+            self.clear_cells(tiles)
+
+        if self.buffer.get_bytesize() != 4:
+            self._blit_tiles(self._skip_covered_tiles(tiles))
+            return
+
+        # tiles that were freed leave unused slots in the atlas
+        if (self._atlas_format != self._tile_format or
+                len(self._atlas_tiles) > 2 * len(self._atlas) + 256):
+            self._reset_atlas()
+            self._atlas_format = self._tile_format
+
+        positions = numpy.fromiter(chain.from_iterable(tiles), numpy.int64,
+                                   len(tiles) * 3).reshape(-1, 3)
+        indexes = self._get_indexes(tiles, positions)
+        atlas = self._get_atlas_arrays()
+        tile_kinds = atlas[0][indexes]
+
+        # oversize tiles cover other cells, so the order of every blit counts
+        if (tile_kinds == TILE_OVERSIZE).any():
+            self._blit_tiles(self._skip_covered_tiles(tiles))
+            return
+
+        # cells that are drawn with pygame, because of some of their tiles
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+        columns = self.buffer.get_width() // tw
+        rows = self.buffer.get_height() // th
+        cx = positions[:, 0] - self.view.left
+        cy = positions[:, 1] - self.view.top
+        outside = (cx < 0) | (cx >= columns) | (cy < 0) | (cy >= rows)
+        cell = numpy.where(outside, 0, cy * columns + cx)
+        special = tile_kinds == TILE_PYGAME
+        statics = self._static_images
+        if statics:
+            special |= numpy.array([i in statics for i in tiles], dtype=bool)
+
+        slow_cells = numpy.zeros(columns * rows, dtype=bool)
+        slow_cells[cell[special & ~outside]] = True
+        slow = outside | slow_cells[cell]
+
+        fast = numpy.flatnonzero(~slow & (tile_kinds != TILE_NONE))
+        if len(fast):
+            self._draw_tiles(fast, cell, cx, cy, positions[:, 2], indexes,
+                             atlas, columns * rows)
+            self.buffer_changed = True
+
+        if slow.any():
+            self._blit_tiles(self._skip_covered_tiles(
+                [tiles[i] for i in numpy.flatnonzero(slow)]))
+
+    def _draw_tiles(self, fast, cell, cx, cy, layers, indexes, atlas,
+                    cell_count):
+        """ Draw tiles into the buffers with numpy
+
+        Tiles are drawn in rounds, with no more than one tile of a cell in
+        each round, so tiles of a cell are drawn in the order of the batch.
+        Tiles that are covered by a later opaque tile are not drawn.
+        """
+        import numpy
+
+        if self._layer_buffers:
+            buffers = self._buffers
+            buffer_of_layer = dict((l, buffers.index(b)) for l, b in
+                                   self._layer_buffers.items())
+            tile_buffers = numpy.array([buffer_of_layer[l] for l in
+                                        layers[fast].tolist()],
+                                       dtype=numpy.int64)
+        else:
+            buffers = [self.buffer]
+            tile_buffers = numpy.zeros(len(fast), dtype=numpy.int64)
+
+        # tiles of each cell of each buffer, in the order of the batch
+        key = tile_buffers * cell_count + cell[fast]
+        order = numpy.argsort(key, kind='stable')
+        fast = fast[order]
+        key = key[order]
+        tile_buffers = tile_buffers[order]
+        count = len(fast)
+        place = numpy.arange(count)
+        starts = numpy.ones(count, dtype=bool)
+        starts[1:] = key[1:] != key[:-1]
+        group = numpy.cumsum(starts) - 1
+
+        # keep the last opaque tile of a cell and the tiles after it
+        opaque = atlas[0][indexes[fast]] == TILE_COPY
+        last_opaque = numpy.maximum.reduceat(
+            numpy.where(opaque, place, -1), numpy.flatnonzero(starts))
+        keep = place >= last_opaque[group]
+        fast = fast[keep]
+        tile_buffers = tile_buffers[keep]
+        group = group[keep]
+
+        # nth tile of each cell
+        count = len(fast)
+        place = numpy.arange(count)
+        starts = numpy.ones(count, dtype=bool)
+        starts[1:] = group[1:] != group[:-1]
+        nth = place - numpy.maximum.accumulate(numpy.where(starts, place, 0))
+
+        views = dict()
+        try:
+            for n in range(nth.max() + 1):
+                in_round = nth == n
+                for b in numpy.unique(tile_buffers[in_round]).tolist():
+                    chosen = fast[in_round & (tile_buffers == b)]
+                    if b not in views:
+                        views[b] = self._cell_views(buffers[b])
+                    self._draw_round(views[b], cx[chosen], cy[chosen],
+                                     indexes[chosen], atlas)
+        finally:
+            # the buffers are locked until the views are gone
+            views.clear()
+
+    def _draw_round(self, views, cx, cy, indexes, atlas):
+        """ Draw tiles into different cells of a buffer
+        """
+        import numpy
+
+        kinds, colors, slots, premultiplied, inverse = atlas
+        words, channels = views
+        tile_kinds = kinds[indexes]
+
+        copy = tile_kinds == TILE_COPY
+        if copy.any():
+            words[cy[copy], cx[copy]] = colors[indexes[copy]]
+
+        blend = tile_kinds == TILE_BLEND
+        if blend.any():
+            x, y, i = cx[blend], cy[blend], slots[indexes[blend]]
+
+            # pygame blends with ((s - d) * a + s >> 8) + d, which is the
+            # same as this, and this fits in 16 bits
+            dst = channels[y, x].astype(numpy.uint16)
+            dst *= inverse[i]
+            dst += premultiplied[i]
+            dst >>= 8
+            channels[y, x] = dst
+
+    def _cell_views(self, buffer):
+        """ Return writable arrays of the cells of a buffer
+
+        The first array has the pixels as 32 bit words, with a shape of
+        (rows, columns, tileheight, tilewidth), the second has the bytes of
+        the pixels, with a shape of (rows, columns, tileheight, tilewidth * 4).
+        Cells that are not wholly in the buffer are left out.
+        """
+        from numpy.lib.stride_tricks import as_strided
+
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+        pixels = pygame.surfarray.pixels2d(buffer).T
+        columns = pixels.shape[1] // tw
+        rows = pixels.shape[0] // th
+        pitch = pixels.strides[0]
+        words = as_strided(pixels, (rows, columns, th, tw),
+                           (pitch * th, tw * 4, pitch, 4))
+        channels = as_strided(pixels.view('uint8'),
+                              (rows, columns, th, tw * 4),
+                              (pitch * th, tw * 4, pitch, 1))
+        return words, channels
+
+    def _get_indexes(self, tiles, positions):
+        """ Return array of the atlas indexes of (x, y, layer) tiles
+
+        Cells that are not in the layer indexes yet are looked up and added.
+        Animated cells and cells outside of the map are looked up each time.
+        """
+        import numpy
+
+        width = self.data.width
+        height = self.data.height
+        if self._layer_index_size != (width, height):
+            self._layer_index = dict()
+            self._layer_index_size = width, height
+
+        x, y, l = positions.T
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        indexes = numpy.full(len(tiles), -1, dtype=numpy.int64)
+        layer_index = self._layer_index
+        for layer in numpy.unique(l[inside]).tolist():
+            index = layer_index.get(layer)
+            if index is None:
+                index = numpy.full((height, width), -1, dtype=numpy.int32)
+                layer_index[layer] = index
+            chosen = numpy.flatnonzero(inside & (l == layer))
+            indexes[chosen] = index[y[chosen], x[chosen]]
+
+        get_tile = self.get_tile_image
+        get_atlas_index = self._get_atlas_index
+        animated = self._animated_tiles
+        for i in numpy.flatnonzero(indexes < 0).tolist():
+            position = tiles[i]
+            atlas_index = get_atlas_index(get_tile(position))
+            indexes[i] = atlas_index
+            if inside[i] and position not in animated:
+                layer_index[position[2]][position[1], position[0]] = \
+                    atlas_index
+
+        return indexes
+
+    def _get_atlas_index(self, tile):
+        """ Return the index of a tile in the atlas, adding it if needed
+
+        The colors of the tile are kept as pixels of the format of the
+        buffer.
+        """
+        if not tile:
+            return 0
+
+        try:
+            return self._atlas[tile]
+        except KeyError:
+            pass
+
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+        surface_alpha = tile.get_alpha()
+        if tile.get_size() != (tw, th):
+            kind, alpha = TILE_OVERSIZE, None
+        elif tile.get_flags() & pygame.SRCALPHA:
+            if surface_alpha not in (None, 255):
+                kind, alpha = TILE_PYGAME, None
+            else:
+                kind = TILE_BLEND
+                alpha = pygame.surfarray.array_alpha(tile).T
+        elif surface_alpha not in (None, 255):
+            kind, alpha = TILE_PYGAME, None
+        elif tile.get_colorkey() is not None:
+            kind = TILE_BLEND
+            alpha = pygame.surfarray.array_colorkey(tile).T
+        else:
+            kind, alpha = TILE_COPY, None
+
+        colors = None
+        if kind in (TILE_COPY, TILE_BLEND):
+            pixels = pygame.Surface((tw, th), 0, self.buffer)
+            pygame.surfarray.blit_array(pixels,
+                                        pygame.surfarray.array3d(tile))
+            colors = pygame.surfarray.array2d(pixels).T
+
+        index = len(self._atlas_tiles)
+        self._atlas[tile] = index
+        self._atlas_tiles.append((kind, colors, alpha))
+        self._atlas_arrays = None
+        return index
+
+    def _get_atlas_arrays(self):
+        """ Return the arrays of the atlas
+
+        They are the kind of each tile, the pixels of opaque tiles, the slot
+        of each blended tile in the last two arrays, and for blended tiles
+        their bytes multiplied by alpha + 1, and 256 - alpha for each byte.
+        """
+        import numpy
+
+        if self._atlas_arrays is None:
+            tw = self.data.tilewidth
+            th = self.data.tileheight
+            count = len(self._atlas_tiles)
+            kinds = numpy.zeros(count, dtype=numpy.int8)
+            colors = numpy.zeros((count, th, tw), dtype=numpy.uint32)
+            slots = numpy.zeros(count, dtype=numpy.int64)
+            blended = list()
+            for i, (kind, pixels, alpha) in enumerate(self._atlas_tiles):
+                kinds[i] = kind
+                if kind == TILE_COPY:
+                    colors[i] = pixels
+                elif kind == TILE_BLEND:
+                    slots[i] = len(blended)
+                    blended.append((pixels, alpha))
+
+            premultiplied = numpy.zeros((len(blended), th, tw * 4),
+                                        dtype=numpy.uint16)
+            inverse = numpy.zeros((len(blended), th, tw * 4),
+                                  dtype=numpy.uint16)
+            for i, (pixels, alpha) in enumerate(blended):
+                channels = numpy.ascontiguousarray(pixels).view(numpy.uint8)
+                alpha = numpy.repeat(alpha.astype(numpy.uint16), 4, axis=1)
+                premultiplied[i] = channels * (alpha + 1)
+                inverse[i] = 256 - alpha
+
+            self._atlas_arrays = kinds, colors, slots, premultiplied, inverse
+
+        return self._atlas_arrays
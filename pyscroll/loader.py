@@ -0,0 +1,167 @@
+"""
+Load maps with tile surfaces that are shared by every map in the process.
+
+Tiles are cached by the path of the tileset image and the rect of the tile,
+so maps that use the same tilesets get the same surfaces, and a tileset is
+only decoded again if some of its tiles are not in the cache.  The cache
+holds weak references, so tiles are dropped when no map uses them anymore.
+
+Shared tiles must not be drawn on.
+
+load_pygame can also decode the tileset images in a pool of threads or
+processes.  Workers send the pixels back as bytes, and the surfaces are made
+on the main thread, since pygame surfaces cannot be shared with other
+processes.
+"""
+
+import os
+import weakref
+
+__all__ = ['load_pygame', 'image_loader', 'decode_images', 'clear_cache']
+
+# (path, colorkey, pixelalpha, rect, flags) -> tile surface
+_tiles = weakref.WeakValueDictionary()
+
+
+def image_loader(filename, colorkey, **kwargs):
+    """ pytmx image loader that shares tiles between maps
+
+    Use it like pytmx.util_pygame.pygame_image_loader.  The image file is
+    not decoded until a tile is asked for that is not in the cache.  If the
+    images keyword is a dict of decoded images by absolute path, the image
+    is taken from it instead of being decoded.
+    """
+    import pygame
+    from pytmx.util_pygame import handle_transformation, smart_convert
+
+    pixelalpha = kwargs.get('pixelalpha', True)
+    path = os.path.abspath(filename)
+    base = (path, colorkey, pixelalpha)
+    images = kwargs.get('images') or dict()
+    loaded = dict()
+
+    def get_image():
+        try:
+            return loaded['image']
+        except KeyError:
+            image = images.get(path) or pygame.image.load(filename)
+            loaded['image'] = image
+            return image
+
+    def load_image(rect=None, flags=None):
+        key = base + (tuple(rect) if rect else None, flags)
+        try:
+            return _tiles[key]
+        except KeyError:
+            pass
+
+        image = get_image()
+        if rect:
+            tile = image.subsurface(rect)
+        else:
+            tile = image.copy()
+
+        if flags:
+            tile = handle_transformation(tile, flags)
+
+        if colorkey:
+            key_color = pygame.Color('#{0}'.format(colorkey))
+        else:
+            key_color = None
+
+        tile = smart_convert(tile, key_color, pixelalpha)
+        _tiles[key] = tile
+        return tile
+
+    return load_image
+
+
+def load_pygame(filename, *args, **kwargs):
+    """ Load a TMX file with shared tiles, and return a pytmx TiledMap
+
+    This is the same as pytmx.load_pygame, but tiles come from the cache.
+    These keywords are used by pyscroll and are not passed to pytmx:
+
+    @param workers:
+        If set, the images of tiles that are not in the cache are decoded
+        at the same time by this many workers.
+
+    @param use_processes:
+        If True, the workers are processes instead of threads.
+    """
+    import functools
+    import pytmx
+
+    workers = kwargs.pop('workers', None)
+    use_processes = kwargs.pop('use_processes', False)
+    if not workers:
+        kwargs['image_loader'] = image_loader
+        return pytmx.TiledMap(filename, *args, **kwargs)
+
+    # without an image loader, pytmx lists the file and rect of every tile
+    tmx = pytmx.TiledMap(filename, *args, **kwargs)
+    cached = set((key[0], key[3], key[4]) for key in list(_tiles.keys()))
+    paths = set()
+    for image in tmx.images:
+        if image:
+            path, rect, flags = image
+            key = (os.path.abspath(path), tuple(rect) if rect else None, flags)
+            if key not in cached:
+                paths.add(path)
+
+    images = decode_images(sorted(paths), workers, use_processes)
+    tmx.image_loader = functools.partial(image_loader, images=images)
+    tmx.reload_images()
+    return tmx
+
+
+def decode_images(paths, workers, use_processes=False):
+    """ Decode image files in a pool, and return dict of surfaces by path
+
+    The keys of the dict are absolute paths.
+    """
+    import pygame
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    if not paths:
+        return dict()
+
+    if use_processes:
+        pool = multiprocessing.Pool(workers, _reset_sigterm)
+    else:
+        pool = ThreadPool(workers)
+
+    try:
+        results = pool.map(_decode_image, paths)
+    finally:
+        pool.terminate()
+
+    fromstring = pygame.image.fromstring
+    return dict((os.path.abspath(path), fromstring(pixels, size, 'RGBA'))
+                for path, size, pixels in results)
+
+
+def _reset_sigterm():
+    """ Give SIGTERM back its default handler in a pool worker
+
+    Workers are forked from a process where pygame may have taken over
+    SIGTERM, and the pool could not stop them.
+    """
+    import signal
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _decode_image(path):
+    import pygame
+    image = pygame.image.load(path)
+    return path, image.get_size(), pygame.image.tostring(image, 'RGBA')
+
+
+def clear_cache():
+    """ Forget all cached tiles
+
+    Maps that are loaded keep their tiles, but they will not be shared with
+    maps that are loaded later.
+    """
+    _tiles.clear()
@@ -0,0 +1,113 @@
+"""
+Small, cached overview image of a whole map.
+"""
+
+import pygame
+from itertools import product
+from six.moves import range
+
+__all__ = ['Minimap']
+
+
+class Minimap(object):
+    """ Downsampled image of a map that is rendered once and then cached
+
+    Every tile is shrunk to tile_size pixels square, so with a tile_size of
+    1 each cell of the map is one pixel of its average color.  Shrunk tiles
+    are cached by tile surface, so each distinct tile is only scaled once.
+
+    When cells of the map change, pass them to invalidate(); only those
+    cells are rendered again on the next update().  Tiles changed with the
+    set_tile or set_tiles methods of the data are invalidated automatically.
+
+    If a renderer is passed, tiles are looked up through the renderer, so
+    the minimap uses the same tiles (and tile cache) that it draws with.
+    """
+
+    def __init__(self, data, tile_size=1, renderer=None,
+                 background=(0, 0, 0)):
+        self.data = data
+        self.tile_size = tile_size
+        self.background = background
+        self.cache = dict()
+        self.dirty = set()
+
+        if renderer is None:
+            self.get_tile_image = data.get_tile_image
+        else:
+            self.get_tile_image = renderer.get_tile_image
+
+        listeners = getattr(data, 'tile_listeners', None)
+        if listeners is not None:
+            listeners.append(self.invalidate_tiles)
+
+        self.image = pygame.Surface((data.width * tile_size,
+                                     data.height * tile_size))
+        self.redraw()
+
+    def shrink(self, tile):
+        """ Return the tile scaled to the minimap size, cached
+        """
+        try:
+            return self.cache[tile]
+        except KeyError:
+            pass
+
+        size = (self.tile_size, self.tile_size)
+        try:
+            small = pygame.transform.smoothscale(tile, size)
+        except ValueError:
+            # smoothscale only works with 24 and 32 bit surfaces
+            small = pygame.transform.scale(tile, size)
+
+        self.cache[tile] = small
+        return small
+
+    def redraw(self):
+        """ Render every cell of the map -- it is slow.
+        """
+        self.dirty.clear()
+        self.render_cells(product(range(self.data.width),
+                                  range(self.data.height)))
+
+    def invalidate(self, cells):
+        """ Mark (x, y) cells to be rendered again by the next update
+        """
+        self.dirty.update(cells)
+
+    def invalidate_tiles(self, positions):
+        """ Mark the cells of (x, y, layer) positions to be rendered again
+        """
+        data = self.data
+        size = (data.width * self.tile_size, data.height * self.tile_size)
+        if self.image.get_size() != size:
+            # the map was replaced with one of a different size
+            self.image = pygame.Surface(size)
+            self.invalidate(product(range(data.width), range(data.height)))
+        else:
+            self.invalidate((x, y) for x, y, l in positions)
+
+    def update(self):
+        """ Render cells that have changed since the last update
+        """
+        if self.dirty:
+            cells = self.dirty
+            self.dirty = set()
+            self.render_cells(cells)
+
+    def render_cells(self, cells):
+        ts = self.tile_size
+        fill = self.image.fill
+        blit = self.image.blit
+        get_tile = self.get_tile_image
+        shrink = self.shrink
+        background = self.background
+        layers = list(self.data.visible_tile_layers)
+
+        for x, y in cells:
+            position = (x * ts, y * ts)
+            fill(background, (position, (ts, ts)))
+            for l in layers:
+                tile = get_tile((x, y, l))
+                if tile:
+                    blit(shrink(tile), position)
@@ -1,11 +1,73 @@
 import pygame
-import pygame.gfxdraw
 import math
 import threading
+import weakref
 from itertools import islice, product, chain
-from six.moves import queue, range
+from six.moves import queue, range, filter
 from . import quadtree
 
+# converted tiles shared by all renderers: buffer format -> {tile: converted}
+# tiles are weak keys, so they are dropped with the maps that use them
+_shared_converted = dict()
+
+
+def merge_cells(cells):
+    """ Return (x, y, width, height) rects that exactly cover a set of cells
+
+    Cells in a row are joined into runs, and runs with the same columns in
+    rows next to each other are joined into one rect, so a strip of cells
+    along an edge of the view becomes a single rect.
+    """
+    rows = dict()
+    for x, y in cells:
+        rows.setdefault(y, list()).append(x)
+
+    rects = list()
+    open_rects = dict()
+    for y in sorted(rows):
+        columns = sorted(rows[y])
+        runs = list()
+        start = prev = columns[0]
+        for x in columns[1:]:
+            if x != prev + 1:
+                runs.append((start, prev - start + 1))
+                start = x
+            prev = x
+        runs.append((start, prev - start + 1))
+
+        still_open = dict()
+        for run in runs:
+            rect = open_rects.pop(run, None)
+            if rect is not None and rect[1] + rect[3] == y:
+                rect[3] += 1
+            else:
+                if rect is not None:
+                    rects.append(rect)
+                rect = [run[0], y, run[1], 1]
+            still_open[run] = rect
+        rects.extend(open_rects.values())
+        open_rects = still_open
+
+    rects.extend(open_rects.values())
+    return [tuple(i) for i in rects]
+
+
+def merge_rects(rects):
+    """ Return list of rects where rects that overlap are joined into one
+
+    A rect that grows may overlap rects that were already joined, so they
+    are taken out again until it overlaps none of them.  No area of the
+    returned rects is covered twice.
+    """
+    merged = list()
+    for rect in rects:
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect = rect.union(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
 
 class BufferedRenderer(object):
     """ Renderer that can be updated incrementally
@@ -17,29 +79,42 @@ class BufferedRenderer(object):
     surfaces (usually from sprites) in the map, creating an illusion of depth.
 
     This class works well for maps that operate on a small display and where
-    the map is much larger than the display, but you will get poor performance
-    if the map is smaller than the display.
+    the map is much larger than the display.  If prerender_limit is set,
+    maps that take less than prerender_limit bytes as an image are rendered
+    whole into the buffer once, and are then drawn with one blit, without
+    scrolling the buffer.
 
     The buffered renderer must be used with a data class to get tile and shape
     information.  See the data class api in pyscroll.data, or use the built in
     pytmx support.
     """
     def __init__(self, data, size, colorkey=None, padding=4,
-                 clamp_camera=False):
+                 clamp_camera=False, prerender_limit=0):
 
         # default options
         self.colorkey = colorkey
         self.padding = padding
         self.clamp_camera = clamp_camera
+        self.prerender_limit = prerender_limit
         self.clipping = True
         self.flush_on_draw = True
         self.update_rate = 25
         self.default_shape_texture_gid = 1
         self.default_shape_color = (0, 255, 0)
+        self.layer_groups = None
 
         # internal defaults
         self.idle = False
         self.blank = False
+        self.prerendered = False
+        self.buffer_changed = True
+        self._last_draw_rect = None
+        self._static_images = dict()
+        self._bottom_layers = dict()
+        self._bottom_layers_key = None
+        self._converted_tiles = weakref.WeakKeyDictionary()
+        self._unconverted_tiles = weakref.WeakSet()
+        self._tile_format = None
         self.data = None
         self.size = None
         self.xoffset = None
@@ -48,6 +123,11 @@ class BufferedRenderer(object):
         self.old_y = None
         self.default_image = None
         self.buffer = None
+        self._buffers = list()
+        self._group_layers = list()
+        self._layer_buffers = None
+        self._shown_groups = (0,)
+        self._quadtree_size = (0, 0)
         self.rect = None
         self.view = None
         self.half_width = None
@@ -59,19 +139,109 @@ class BufferedRenderer(object):
         self.queue = iter([])
 
     def set_data(self, data):
+        # stop listening to changes of the old data
+        listeners = getattr(self.data, 'tile_listeners', None)
+        if listeners and self.invalidate_tiles in listeners:
+            listeners.remove(self.invalidate_tiles)
+
         self.data = data
+        listeners = getattr(data, 'tile_listeners', None)
+        if listeners is not None:
+            listeners.append(self.invalidate_tiles)
+
+        self._converted_tiles = weakref.WeakKeyDictionary()
+        self._unconverted_tiles = weakref.WeakSet()
+        self._bottom_layers = dict()
+        self._bottom_layers_key = None
         self.generate_default_image()
+        self.set_animations(getattr(data, 'animations', None),
+                            getattr(data, 'animated_tiles', None))
+
+    def set_animations(self, animations, animated_tiles):
+        """ Set the tile animations that the renderer will play
+
+        animations is a dict of gid: ((frame gid, duration in ms), ...) and
+        animated_tiles is a dict of (x, y, layer): gid for every animated
+        tile of the map.  Both are read from the data class by set_data.
+        """
+        # the dict is shared, so tiles changed in the data are seen here
+        if animated_tiles is None:
+            animated_tiles = dict()
+
+        self._animations = animations or dict()
+        self._animated_tiles = animated_tiles
+        self._animation_time = 0
+        self._animation_frames = dict()
+        self._animation_images = dict()
+        self._animated_rows = dict()
+        self._visible_animated = dict()
+        self._visible_animated_view = None
+
+        get_image = self.data.get_tile_image_by_gid
+        for gid, frames in self._animations.items():
+            self._animation_frames[gid] = 0
+            self._animation_images[gid] = get_image(frames[0][0])
+
+        # animated tiles by row, to find the ones in the view quickly
+        for (x, y, l), gid in self._animated_tiles.items():
+            self._animated_rows.setdefault(y, list()).append((x, l, gid))
 
     def set_size(self, size):
         """ Set the size of the map in pixels
+
+        If the map has been drawn already, the part of the buffer that is
+        still in the view is copied to the new buffer, and only the cells
+        that were not in the old buffer are queued to be drawn.
+
+        If the whole map fits in prerender_limit bytes, the buffer holds the
+        whole map, and changing the size does not draw anything.
         """
         tw = self.data.tilewidth
         th = self.data.tileheight
+        map_width = self.data.width * tw
+        map_height = self.data.height * th
+        prerender = map_width * map_height * 4 <= self.prerender_limit
+
+        if prerender and self.prerendered and not self.blank:
+            # the whole map is in the buffer already, only the camera changes
+            self.half_width = size[0] / 2
+            self.half_height = size[1] / 2
+            self.size = size
+            self.idle = False
+            x, y = self._camera_position((self.old_x, self.old_y))
+            self._set_offsets(x, y)
+            self.old_x, self.old_y = x, y
+            self.buffer_changed = True
+            return
+
+        # keep the old buffers, if there is anything in them worth keeping
+        old_buffers = None
+        if (self.buffer is not None and not self.blank and
+                not prerender and not self.prerendered):
+            self.flush()
+            old_buffers = self._buffers
+            old_group_layers = self._group_layers
+            old_view = self.view
 
-        buffer_width = size[0] + tw * self.padding
-        buffer_height = size[1] + th * self.padding
+        self.prerendered = prerender
+        if prerender:
+            buffer_width, buffer_height = map_width, map_height
+        else:
+            buffer_width = size[0] + tw * self.padding
+            buffer_height = size[1] + th * self.padding
         self.buffer = pygame.Surface((buffer_width, buffer_height))
 
+        # match the display, so the buffer is blitted without conversion
+        if pygame.display.get_surface() is not None:
+            self.buffer = self.buffer.convert()
+
+        # tiles are converted to the format of the buffer
+        tile_format = (self.buffer.get_bitsize(), self.buffer.get_masks())
+        if tile_format != self._tile_format:
+            self._tile_format = tile_format
+            self._converted_tiles = weakref.WeakKeyDictionary()
+            self._unconverted_tiles = weakref.WeakSet()
+
         self.view = pygame.Rect(0, 0,
                                 math.ceil(buffer_width / tw),
                                 math.ceil(buffer_height / th))
@@ -80,6 +250,8 @@ class BufferedRenderer(object):
             self.buffer.set_colorkey(self.colorkey)
             self.buffer.fill(self.colorkey)
 
+        self._make_buffers()
+
         # this is the pixel size of the entire map
         self.rect = pygame.Rect(0, 0,
                                 self.data.width * tw,
@@ -87,37 +259,247 @@ class BufferedRenderer(object):
 
         self.half_width = size[0] / 2
         self.half_height = size[1] / 2
+        self.size = size
+        self.idle = False
 
-        # quadtree is used to correctly draw tiles that cover 'sprites'
-        def make_rect(x, y):
-            return pygame.Rect((x * tw, y * th), (tw, th))
+        # quadtree is used to correctly draw tiles that cover 'sprites'.
+        # it is only built again if the view grows larger than it, and then
+        # with some room to spare, so dragging a window edge rarely builds it.
+        # a prerendered buffer does not use it, see _draw_map.
+        qw, qh = self._quadtree_size
+        if not prerender and (self.view.width > qw or
+                              self.view.height > qh):
+            if old_buffers is not None:
+                qw = max(qw, int(self.view.width * 1.25))
+                qh = max(qh, int(self.view.height * 1.25))
+            else:
+                qw, qh = self.view.size
+            self._quadtree_size = qw, qh
 
-        rects = [make_rect(x, y)
-                 for x, y in product(range(self.view.width),
-                                     range(self.view.height))]
+            def make_rect(x, y):
+                return pygame.Rect((x * tw, y * th), (tw, th))
 
-        # TODO: figure out what depth -actually- does
-        self.layer_quadtree = quadtree.FastQuadTree(rects, 1)
+            rects = [make_rect(x, y) for x, y in product(range(qw), range(qh))]
+
+            # TODO: figure out what depth -actually- does
+            self.layer_quadtree = quadtree.FastQuadTree(rects, 1)
+
+        if old_buffers is not None and len(old_buffers) == len(self._buffers):
+            self._resize_buffers(old_buffers, old_group_layers, old_view)
+            return
 
-        self.size = size
-        self.idle = False
         self.blank = True
         self.xoffset = 0
         self.yoffset = 0
         self.old_x = 0
         self.old_y = 0
 
+    def _resize_buffers(self, old_buffers, old_group_layers, old_view):
+        """ Copy the old buffers into the new ones after the size changed
+        """
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+
+        # the camera stays where it was, so the view moves by half of the
+        # change in size
+        x, y = self._camera_position((self.old_x, self.old_y))
+        view = self.view
+        view.topleft = old_view.topleft
+        dx, dy = self._set_offsets(x, y)
+        view.move_ip(dx, dy)
+        self.old_x, self.old_y = x, y
+
+        # buffers with a colorkey are filled with it, so blitting the old
+        # buffer on them copies it exactly
+        for old, new in zip(old_buffers, self._buffers):
+            new.blit(old, (-dx * tw, -dy * th))
+        if self.layer_groups:
+            self._group_layers = old_group_layers
+
+        # queue cells that were only partly in the old buffer, or not at all
+        width, height = old_buffers[0].get_size()
+        kept = pygame.Rect(old_view.topleft, (width // tw, height // th))
+        self._queue_cells(((x, y) for x, y in
+                           product(range(view.left, view.right),
+                                   range(view.top, view.bottom))
+                           if not kept.collidepoint(x, y)), clear=True)
+        self.buffer_changed = True
+
+    def set_layer_groups(self, groups):
+        """ Render groups of tile layers into separate buffers
+
+        groups is a list of lists of tile layer numbers, from the bottom up,
+        or None to draw all layers into one buffer.  The buffers are blitted
+        in order when the map is drawn, and a group is left out while none of
+        its layers are visible, so hiding or showing a whole group does not
+        draw any tiles.  If only some layers of a group are hidden, just that
+        group is drawn again.  Layers that are in no group are not drawn.
+
+        Groups above the first are cleared with the colorkey of the renderer,
+        or magenta if it has none.  Tiles are not skipped when they are
+        covered by opaque tiles, since the covering group may be hidden.
+        """
+        if groups is None:
+            self.layer_groups = None
+        else:
+            self.layer_groups = [tuple(int(l) for l in g) for g in groups]
+
+        if self.buffer is not None:
+            self._make_buffers()
+            self.blank = True
+
+    def _make_buffers(self):
+        """ Make the buffers of the layer groups, if there are any
+        """
+        self._buffers = [self.buffer]
+        self._group_layers = list()
+        self._layer_buffers = None
+        self._shown_groups = (0,)
+
+        groups = self.layer_groups
+        if not groups:
+            return
+
+        key = self.colorkey or (255, 0, 255)
+        for group in groups[1:]:
+            buffer = self.buffer.copy()
+            buffer.set_colorkey(key)
+            buffer.fill(key)
+            self._buffers.append(buffer)
+
+        visible = set(self.data.visible_tile_layers)
+        self._layer_buffers = dict()
+        for group, buffer in zip(groups, self._buffers):
+            # a group that is hidden now is drawn, so showing it is free
+            layers = tuple(l for l in group if l in visible) or group
+            self._group_layers.append(layers)
+            for l in group:
+                self._layer_buffers[l] = buffer
+        self._shown_groups = None
+
+    def _tile_layers(self, groups=None):
+        """ Return tuple of the tile layers that are drawn into the buffers
+
+        With layer groups, only the layers of the group numbers in groups
+        are returned, if it is given.
+        """
+        if not self.layer_groups:
+            return tuple(self.data.visible_tile_layers)
+
+        if groups is None:
+            groups = range(len(self._group_layers))
+        layers = self._group_layers
+        return tuple(sorted(chain.from_iterable(layers[i] for i in groups)))
+
+    def _update_layer_groups(self):
+        """ Find the groups to show, and draw groups with changed layers
+        """
+        visible = set(self.data.visible_tile_layers)
+        view = self.view
+        shown = list()
+        for i, group in enumerate(self.layer_groups):
+            layers = tuple(l for l in group if l in visible)
+            if not layers:
+                continue
+
+            shown.append(i)
+            if layers != self._group_layers[i]:
+                self._group_layers[i] = layers
+                buffer = self._buffers[i]
+                with self.lock:
+                    buffer.fill(buffer.get_colorkey() or (0, 0, 0))
+                self.update_queue(product(range(view.left, view.right),
+                                          range(view.top, view.bottom),
+                                          layers))
+
+        shown = tuple(shown)
+        if shown != self._shown_groups:
+            self._shown_groups = shown
+            self.buffer_changed = True
+
     def generate_default_image(self):
         self.default_image = pygame.Surface((self.data.tilewidth,
                                              self.data.tileheight))
         self.default_image.fill((0, 0, 0))
 
     def get_tile_image(self, position):
+        animated = self._animated_tiles
         try:
-            return self.data.get_tile_image(position)
+            if animated and position in animated:
+                image = self._animation_images[animated[position]]
+            else:
+                image = self.data.get_tile_image(position)
         except ValueError:
             return self.default_image
 
+        if not image:
+            return image
+
+        try:
+            return self._converted_tiles[image]
+        except KeyError:
+            return self.convert_tile(image)
+
+    def convert_tile(self, image):
+        """ Return a copy of a tile that is fast to blit onto the buffer
+
+        Opaque tiles are converted to the format of the buffer with no alpha
+        or colorkey, so they are blitted with a plain copy.  Only tiles with
+        partial transparency keep per-pixel alpha, and tiles with a colorkey
+        or surface alpha use RLE acceleration.  Empty tiles become None.
+
+        The result is cached, so each tile is only converted once, and is
+        shared with other renderers whose buffers have the same format.  If
+        the display is not initialized, the tile cannot be converted and is
+        used as it is.  The caches hold weak references to the tiles, so
+        tiles of maps that are not used anymore are freed.
+        """
+        from .data import get_image_opacity, TILE_EMPTY, TILE_OPAQUE
+
+        if image in self._unconverted_tiles:
+            return image
+
+        try:
+            shared = _shared_converted[self._tile_format]
+        except KeyError:
+            shared = weakref.WeakKeyDictionary()
+            _shared_converted[self._tile_format] = shared
+
+        try:
+            converted = self._converted_tiles[image] = shared[image]
+            return converted
+        except KeyError:
+            pass
+
+        opacity = get_image_opacity(image)
+        try:
+            if opacity == TILE_EMPTY:
+                converted = None
+            elif opacity == TILE_OPAQUE:
+                converted = image.convert(self.buffer)
+                converted.set_colorkey(None)
+                converted.set_alpha(None)
+            elif image.get_flags() & pygame.SRCALPHA:
+                converted = image.convert_alpha()
+            else:
+                converted = image.convert(self.buffer)
+                colorkey = image.get_colorkey()
+                if colorkey is not None:
+                    converted.set_colorkey(colorkey, pygame.RLEACCEL)
+                alpha = image.get_alpha()
+                if alpha is not None:
+                    converted.set_alpha(alpha, pygame.RLEACCEL)
+        except pygame.error:
+            converted = image
+
+        # a tile that is used as it is would keep itself alive in the cache
+        if converted is image:
+            self._unconverted_tiles.add(image)
+        else:
+            shared[image] = converted
+            self._converted_tiles[image] = converted
+        return converted
+
     def scroll(self, vector):
         """ scroll the background in pixels
         """
@@ -126,6 +508,33 @@ class BufferedRenderer(object):
     def center(self, coords):
         """ center the map on a pixel
         """
+        x, y = self._camera_position(coords)
+
+        if self.old_x == x and self.old_y == y:
+            self.idle = True
+            return
+
+        self.idle = False
+        dx, dy = self._set_offsets(x, y)
+
+        # adjust the view if the view has changed
+        if (abs(dx) >= 1) or (abs(dy) >= 1):
+            tw = self.data.tilewidth
+            th = self.data.tileheight
+            self.flush()
+            self.view = self.view.move((dx, dy))
+
+            # scroll the image (much faster than redrawing the tiles!)
+            for buffer in self._buffers:
+                buffer.scroll(-dx * tw, -dy * th)
+            self.buffer_changed = True
+            self.update_queue(self.get_edge_tiles((dx, dy)))
+
+        self.old_x, self.old_y = x, y
+
+    def _camera_position(self, coords):
+        """ Return the pixel the camera is centered on, clamped if needed
+        """
         x, y = [round(i, 0) for i in coords]
 
         if self.clamp_camera:
@@ -138,14 +547,22 @@ class BufferedRenderer(object):
             elif y + self.half_height > self.rect.height:
                 y = self.rect.height - self.half_height
 
-        if self.old_x == x and self.old_y == y:
-            self.idle = True
-            return
+        return x, y
+
+    def _set_offsets(self, x, y):
+        """ Set the offsets of the buffer for a camera position
 
+        Returns how many tiles the view has to move, as dx, dy.
+        """
         hpad = int(self.padding / 2)
         tw = self.data.tilewidth
         th = self.data.tileheight
-        self.idle = False
+
+        # the view is the whole map and never moves
+        if self.prerendered:
+            self.xoffset = x - self.half_width
+            self.yoffset = y - self.half_height
+            return 0, 0
 
         # calc the new postion in tiles and offset
         left, self.xoffset = divmod(x - self.half_width, tw)
@@ -159,16 +576,7 @@ class BufferedRenderer(object):
         self.xoffset += hpad * tw
         self.yoffset += hpad * th
 
-        # adjust the view if the view has changed
-        if (abs(dx) >= 1) or (abs(dy) >= 1):
-            self.flush()
-            self.view = self.view.move((dx, dy))
-
-            # scroll the image (much faster than redrawing the tiles!)
-            self.buffer.scroll(-dx * tw, -dy * th)
-            self.update_queue(self.get_edge_tiles((dx, dy)))
-
-        self.old_x, self.old_y = x, y
+        return dx, dy
 
     def update_queue(self, iterator):
         """ Add some tiles to the queue
@@ -179,7 +587,7 @@ class BufferedRenderer(object):
         """ Get the tile coordinates that need to be redrawn
         """
         x, y = map(int, offset)
-        layers = list(self.data.visible_tile_layers)
+        layers = list(self._tile_layers())
         view = self.view
         queue = None
 
@@ -225,10 +633,69 @@ class BufferedRenderer(object):
         off screen tiles.  this will limit expensive tile blits during screen
         draws.  if your draw and update happens every game loop, then you will
         not benefit from updates, but it won't hurt either.
+
+        dt is the time since the last update in seconds, and is used to play
+        tile animations.
         """
+        self.update_animations(dt)
         self.blit_tiles(islice(self.queue, self.update_rate))
 
-    def draw(self, surface, rect, surfaces=None):
+    def update_animations(self, dt):
+        """ Advance tile animations by dt seconds
+
+        Only animated cells inside the view whose frame has changed are
+        queued to be drawn again.
+        """
+        animations = self._animations
+        if not animations or not dt:
+            return
+
+        self._animation_time += dt * 1000
+        time = self._animation_time
+        frames_now = self._animation_frames
+        get_image = self.data.get_tile_image_by_gid
+
+        changed = list()
+        for gid, frames in animations.items():
+            t = time % sum(i[1] for i in frames)
+            for index, (frame_gid, duration) in enumerate(frames):
+                if t < duration:
+                    break
+                t -= duration
+
+            if index != frames_now[gid]:
+                frames_now[gid] = index
+                self._animation_images[gid] = get_image(frame_gid)
+                changed.append(gid)
+
+        if changed:
+            visible = self._get_visible_animated()
+            cells = list()
+            for gid in changed:
+                cells.extend(visible.get(gid, ()))
+            if cells:
+                self._queue_cells(cells)
+
+    def _get_visible_animated(self):
+        """ Return dict of gid: [(x, y), ...] for animated cells in the view
+
+        The index is rebuilt only when the view has moved.
+        """
+        view = self.view
+        key = tuple(view)
+        if key != self._visible_animated_view:
+            self._visible_animated_view = key
+            visible = dict()
+            left, right = view.left, view.right
+            rows = self._animated_rows
+            for y in range(view.top, view.bottom):
+                for x, l, gid in rows.get(y, ()):
+                    if left <= x < right:
+                        visible.setdefault(gid, list()).append((x, y))
+            self._visible_animated = visible
+        return self._visible_animated
+
+    def draw(self, surface, rect, surfaces=None, dirty_areas=None):
         """ Draw the map onto a surface
 
         pass a rect that defines the draw area for:
@@ -240,13 +707,25 @@ class BufferedRenderer(object):
         rect in screen coordinates.  surfaces will be drawn in order passed,
         and will be correctly drawn with tiles from a higher layer overlapping
         the surface.
+
+        dirty_areas may be a list of rects in screen coordinates that have
+        changed since the last draw.  if the camera is idle and the buffer
+        has not changed, only those areas are restored from the buffer and
+        redrawn, and they are returned as the list of dirty rects.  areas
+        that overlap are joined first, so nothing is drawn twice.
         """
+        # data classes that load parts of the map as needed are told the view
+        update_view = getattr(self.data, 'update_view', None)
+        if update_view is not None:
+            update_view(self.view)
+
         if self.blank:
             self.blank = False
             self.redraw()
 
-        surblit = surface.blit
-        left, top = self.view.topleft
+        if self.layer_groups:
+            self._update_layer_groups()
+
         ox, oy = self.xoffset, self.yoffset
         ox -= rect.left
         oy -= rect.top
@@ -254,57 +733,146 @@ class BufferedRenderer(object):
         if self.flush_on_draw:
             self.flush()
 
+        partial = (dirty_areas is not None and self.idle and
+                   not self.buffer_changed and rect == self._last_draw_rect)
+        self.buffer_changed = False
+        self._last_draw_rect = pygame.Rect(rect)
+
         # need to set clipping otherwise the map will draw outside its area
         original_clip = None
-        if self.clipping:
+        if self.clipping or partial:
             original_clip = surface.get_clip()
-            surface.set_clip(rect)
-
-        # draw the entire map to the surface,
-        # taking in account the scrolling offset
-        surblit(self.buffer, (-ox, -oy))
 
-        if surfaces is None:
-            dirty = list()
+        if partial:
+            areas = [i.clip(rect) for i in dirty_areas]
+            areas = merge_rects(i for i in areas if i.width and i.height)
+            for area in areas:
+                colliderect = area.colliderect
+                surface.set_clip(area)
+                self._draw_map(surface, ox, oy, surfaces and
+                               [i for i in surfaces if colliderect(i[1])])
+            surface.set_clip(original_clip)
+            return areas
 
-        else:
-            def above(x, y):
-                return x > y
+        if self.clipping:
+            surface.set_clip(rect)
 
-            hit = self.layer_quadtree.hit
-            get_tile = self.get_tile_image
-            tile_layers = tuple(self.data.visible_tile_layers)
-            dirty = [(surblit(i[0], i[1]), i[2]) for i in surfaces]
-
-            for dirty_rect, layer in dirty:
-                for r in hit(dirty_rect.move(ox, oy)):
-                    x, y, tw, th = r
-                    for l in [i for i in tile_layers if above(i, layer)]:
-                        tile = get_tile((int(x / tw + left),
-                                         int(y / th + top), int(l)))
-                        if tile:
-                            surblit(tile, (x - ox, y - oy))
+        dirty = self._draw_map(surface, ox, oy, surfaces)
 
         if self.clipping:
             surface.set_clip(original_clip)
 
-        if self.idle:
+        if self.idle and dirty_areas is None:
             return [i[0] for i in dirty]
         else:
             return [rect]
 
+    def _draw_map(self, surface, ox, oy, surfaces):
+        """ Blit the buffer and surfaces, respecting the clip of surface
+
+        returns list of (rect, layer) tuples for the blitted surfaces
+        """
+        surblit = surface.blit
+        left, top = self.view.topleft
+
+        # draw the entire map to the surface,
+        # taking in account the scrolling offset
+        # a prerendered map may not cover the whole area
+        if self.prerendered:
+            area = self.buffer.get_rect(topleft=(-ox, -oy))
+            clip = surface.get_clip()
+            if not area.contains(clip):
+                fill = surface.fill
+                black = (0, 0, 0)
+                fill(black, (clip.left, clip.top,
+                             clip.width, max(0, area.top - clip.top)))
+                fill(black, (clip.left, area.bottom,
+                             clip.width, max(0, clip.bottom - area.bottom)))
+                fill(black, (clip.left, area.top,
+                             max(0, area.left - clip.left), area.height))
+                fill(black, (area.right, area.top,
+                             max(0, clip.right - area.right), area.height))
+
+        buffers = self._buffers
+        for i in self._shown_groups:
+            surblit(buffers[i], (-ox, -oy))
+
+        if not surfaces:
+            return list()
+
+        def above(x, y):
+            return x > y
+
+        if self.prerendered:
+            hit = self._cells_in_rect
+        else:
+            hit = self.layer_quadtree.hit
+        get_tile = self.get_tile_image
+        statics = self._static_images
+        tile_layers = self._tile_layers(self._shown_groups)
+        bottom = self._get_bottom_layers()
+        is_covered = self._is_covered
+        buffer_rect = self.buffer.get_rect()
+        dirty = [(surblit(i[0], i[1]), i[2]) for i in surfaces]
+
+        for dirty_rect, layer in dirty:
+            layers = [i for i in tile_layers if above(i, layer)]
+            # the quadtree may have cells past the edges of the buffer
+            for r in hit(dirty_rect.move(ox, oy).clip(buffer_rect)):
+                x, y, tw, th = r
+                tx, ty = int(x / tw + left), int(y / th + top)
+                for l in layers:
+                    if bottom is not None and is_covered(bottom, tx, ty, l):
+                        continue
+                    position = (tx, ty, int(l))
+                    tile = get_tile(position)
+                    if tile:
+                        surblit(tile, (x - ox, y - oy))
+                    if statics and position in statics:
+                        sx = left * tw + ox
+                        sy = top * th + oy
+                        for image, (px, py), area in statics[position]:
+                            surblit(image, (px - sx, py - sy), area)
+
+        return dirty
+
+    def _cells_in_rect(self, rect):
+        """ Return list of (x, y, w, h) buffer cells that a rect overlaps
+
+        Used instead of the quadtree for a prerendered buffer, which is as
+        large as the map.
+        """
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+        if rect.width <= 0 or rect.height <= 0:
+            return list()
+        return [(x * tw, y * th, tw, th)
+                for y in range(rect.top // th, (rect.bottom - 1) // th + 1)
+                for x in range(rect.left // tw, (rect.right - 1) // tw + 1)]
+
     def flush(self):
         """ Blit the tiles and block until the tile queue is empty
         """
         self.blit_tiles(self.queue)
-        self.draw_objects()
+
+        # objects stay in a prerendered buffer until tiles are drawn again
+        if self.buffer_changed or not self.prerendered:
+            self.draw_objects()
 
     def draw_objects(self):
         """ Totally unoptimized drawing of objects to the map
         """
+        import pygame.gfxdraw
+
+        layers = list(self.data.visible_object_layers)
+        if not layers:
+            return
+
         tw = self.data.tilewidth
         th = self.data.tileheight
-        buff = self.buffer
+        # objects are drawn over all tiles, so they go on the top buffer
+        buff = self._buffers[-1]
+        buff_rect = buff.get_rect()
         blit = buff.blit
         map_gid = self.data.tmx.map_gid
         default_color = self.default_shape_color
@@ -322,16 +890,37 @@ class BufferedRenderer(object):
             except pygame.error:
                 pass
 
+        def draw_whole(draw, points, width):
+            # pygame moves the ends of lines and edges that are clipped, so a
+            # shape that crosses the edge of the buffer is drawn on its own
+            # surface, and looks the same at every position of the view
+            xs = [i[0] for i in points]
+            ys = [i[1] for i in points]
+            area = pygame.Rect(int(min(xs)) - width, int(min(ys)) - width,
+                               0, 0)
+            area.size = (int(max(xs)) - area.left + width + 1,
+                         int(max(ys)) - area.top + width + 1)
+            if buff_rect.contains(area):
+                draw(buff, points)
+            elif buff_rect.colliderect(area):
+                image = pygame.Surface(area.size, pygame.SRCALPHA)
+                draw(image, [(x - area.left, y - area.top) for x, y in points])
+                blit(image, area)
+
         def draw_poly(color, points, width=0):
-            _draw_poly(buff, color, points, width)
+            def draw(surface, points):
+                _draw_poly(surface, color, points, width)
+            draw_whole(draw, points, width)
 
         def draw_lines(color, points, width=2):
-            _draw_lines(buff, color, False, points, width)
+            def draw(surface, points):
+                _draw_lines(surface, color, False, points, width)
+            draw_whole(draw, points, width)
 
         def to_buffer(pt):
             return pt[0] - ox, pt[1] - oy
 
-        for layer in self.data.visible_object_layers:
+        for layer in layers:
             for o in (o for o in layer if o.visible):
                 texture_gid = getattr(o, "texture", None)
                 color = getattr(o, "color", default_color)
@@ -369,6 +958,21 @@ class BufferedRenderer(object):
 
     def blit_tiles(self, iterator):
         """ Bilts (x, y, layer) tuples to buffer from iterator
+
+        When using a colorkey, cells are cleared before their lowest layer
+        is drawn.  All cells of the batch are cleared first, with one fill
+        for each rectangle of neighboring cells, then the tiles are blitted
+        the same way as without a colorkey.  With layer groups, each tile is
+        blitted to the buffer of its group.
+        """
+        if self.colorkey or self._layer_buffers:
+            iterator = list(iterator)
+            self.clear_cells(iterator)
+
+        self._blit_tiles(self._skip_covered_tiles(iterator))
+
+    def _blit_tiles(self, iterator):
+        """ Blit (x, y, layer) tuples to the buffers, without clearing cells
         """
         tw = self.data.tilewidth
         th = self.data.tileheight
@@ -376,39 +980,244 @@ class BufferedRenderer(object):
         ltw = self.view.left * tw
         tth = self.view.top * th
         get_tile = self.get_tile_image
-
-        if self.colorkey:
-            fill = self.buffer.fill
-            old_tiles = set()
-            for x, y, l in iterator:
-                tile = get_tile((x, y, l))
-                if tile:
-                    if l == 0:
-                        fill(self.colorkey,
-                             (x * tw - ltw, y * th - tth, tw, th))
-                    old_tiles.add((x, y))
-                    blit(tile, (x * tw - ltw, y * th - tth))
-                else:
-                    if l > 0:
-                        if (x, y) not in old_tiles:
-                            fill(self.colorkey,
-                                 (x * tw - ltw, y * th - tth, tw, th))
+        layer_buffers = self._layer_buffers
+        statics = self._static_images
+
+        for x, y, l in iterator:
+            if layer_buffers:
+                blit = layer_buffers[l].blit
+            tile = get_tile((x, y, l))
+            if tile:
+                blit(tile, (x * tw - ltw, y * th - tth))
+                self.buffer_changed = True
+            if statics and (x, y, l) in statics:
+                for image, (px, py), area in statics[(x, y, l)]:
+                    blit(image, (px - ltw, py - tth), area)
+                self.buffer_changed = True
+
+    def clear_cells(self, tiles):
+        """ Fill cells with the colorkey before their tiles are drawn
+
+        tiles is a list of (x, y, layer) tuples.  Only cells where the lowest
+        visible layer of a buffer is in the list are cleared, so a cell that
+        is split between two batches is not cleared again halfway through.
+        """
+        if self.layer_groups:
+            groups = zip(self._buffers, self._group_layers)
         else:
-            for x, y, l in iterator:
-                tile = get_tile((x, y, l))
-                if tile:
-                    blit(tile, (x * tw - ltw, y * th - tth))
+            groups = [(self.buffer, self._tile_layers())]
+
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+        left, top = self.view.topleft
+        for buffer, layers in groups:
+            colorkey = buffer.get_colorkey()
+            if colorkey is None or not layers:
+                continue
+
+            first = layers[0]
+            cells = set((x, y) for x, y, l in tiles if l == first)
+            if not cells:
+                continue
+
+            fill = buffer.fill
+            for x, y, w, h in merge_cells(cells):
+                fill(colorkey,
+                     ((x - left) * tw, (y - top) * th, w * tw, h * th))
+            self.buffer_changed = True
+
+    def _get_bottom_layers(self):
+        """ Return dict of the lowest layer that can be seen for (x, y) cells
+
+        Returns None if the data class cannot tell the opacity of tiles, or
+        if layer groups are used.  The dict is filled in as cells are looked
+        up by _find_bottom_layer, and is cleared when the visible layers
+        change.
+        """
+        if self.layer_groups or not hasattr(self.data, 'get_tile_opacity'):
+            return None
+
+        layers = tuple(self.data.visible_tile_layers)
+        if layers != self._bottom_layers_key:
+            self._bottom_layers_key = layers
+            self._bottom_layers = dict()
+        return self._bottom_layers
+
+    def _find_bottom_layer(self, x, y):
+        """ Return the highest layer with an opaque tile in a cell
+
+        Tiles on lower layers of the cell are covered and are not drawn.
+        """
+        from .data import TILE_OPAQUE
+
+        layers = self._bottom_layers_key
+        bottom = layers[0] if layers else 0
+        get_opacity = self.data.get_tile_opacity
+        animated = self._animated_tiles
+        for l in reversed(layers):
+            # frames of an animation may not all be opaque
+            if (x, y, l) in animated:
+                continue
+            if get_opacity((x, y, l)) == TILE_OPAQUE:
+                bottom = l
+                break
+
+        self._bottom_layers[(x, y)] = bottom
+        return bottom
+
+    def _is_covered(self, bottom, x, y, l):
+        """ Return True if an opaque tile on a higher layer covers the tile
+
+        bottom is the dict from _get_bottom_layers, which should be looked up
+        once for many tiles.
+        """
+        try:
+            return l < bottom[(x, y)]
+        except KeyError:
+            return l < self._find_bottom_layer(x, y)
+
+    def _skip_covered_tiles(self, iterator):
+        """ Filter (x, y, layer) tuples that are covered by opaque tiles
+        """
+        bottom = self._get_bottom_layers()
+        if bottom is None:
+            return iterator
+
+        find = self._find_bottom_layer
+
+        def visible(position):
+            x, y, l = position
+            try:
+                return l >= bottom[(x, y)]
+            except KeyError:
+                return l >= find(x, y)
+
+        return filter(visible, iterator)
 
     def redraw(self):
         """ redraw the visible portion of the buffer -- it is slow.
         """
         queue = product(range(self.view.left, self.view.right),
                         range(self.view.top, self.view.bottom),
-                        self.data.visible_tile_layers)
+                        self._tile_layers())
 
         self.update_queue(queue)
         self.flush()
 
+    def invalidate_tiles(self, positions):
+        """ Draw tiles again after they have changed in the data
+
+        positions is an iterable of (x, y, layer) tuples.  Cached opacity and
+        animation info for the cells is dropped, and cells that are in the
+        view are queued to be drawn again.  This is called by the data class
+        when tiles are changed with set_tile or set_tiles.
+        """
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+        if self.rect.size != (self.data.width * tw, self.data.height * th):
+            # the map was replaced with one of a different size
+            self.blank = True
+            self.set_size(self.size)
+            return
+
+        # the data may have new animations, if the map was reloaded
+        if getattr(self.data, 'animated_tiles', None) is not \
+                self._animated_tiles:
+            self.set_animations(self.data.animations, self.data.animated_tiles)
+
+        positions = list(positions)
+        bottom = self._bottom_layers
+        animated = self._animated_tiles
+        rows = self._animated_rows
+        for x, y, l in positions:
+            bottom.pop((x, y), None)
+            row = [i for i in rows.get(y, ()) if i[:2] != (x, l)]
+            if (x, y, l) in animated:
+                row.append((x, l, animated[(x, y, l)]))
+            if row:
+                rows[y] = row
+            else:
+                rows.pop(y, None)
+
+        self._visible_animated_view = None
+        self._queue_cells(((x, y) for x, y, l in positions), clear=True)
+
+    def _static_image_entries(self, image, position, layer):
+        """ Return the (cell, entry) pairs for a static image
+
+        Each entry is the image, the map position of the part of the image
+        that falls in the cell, and that part as an area of the image.
+        """
+        tw = self.data.tilewidth
+        th = self.data.tileheight
+        rect = image.get_rect(topleft=position)
+        cells = product(range(rect.left // tw, (rect.right - 1) // tw + 1),
+                        range(rect.top // th, (rect.bottom - 1) // th + 1))
+
+        entries = list()
+        for x, y in cells:
+            part = pygame.Rect(x * tw, y * th, tw, th).clip(rect)
+            area = part.move(-rect.left, -rect.top)
+            entries.append(((x, y, layer), (image, part.topleft, area)))
+        return entries
+
+    def add_static_image(self, image, position, layer):
+        """ Draw an image into the buffer as part of the map
+
+        Use this for decorations that never move.  The image is blitted
+        when the tiles under it are, over its layer and under higher layers,
+        and it will cover sprites from lower layers like a tile.  Once it
+        is in the buffer it costs nothing to draw.
+
+        position is the top-left corner of the image in map pixels.
+        layer is a tile layer number.
+        """
+        statics = self._static_images
+        entries = self._static_image_entries(image, position, int(layer))
+        for key, entry in entries:
+            statics.setdefault(key, list()).append(entry)
+        self._queue_cells(key[:2] for key, entry in entries)
+
+    def remove_static_image(self, image, position, layer):
+        """ Remove an image added with add_static_image
+
+        The arguments must be the same as the ones used to add it.
+        """
+        statics = self._static_images
+        entries = self._static_image_entries(image, position, int(layer))
+        for key, entry in entries:
+            images = statics[key]
+            images.remove(entry)
+            if not images:
+                del statics[key]
+        self._queue_cells((key[:2] for key, entry in entries), clear=True)
+
+    def _queue_cells(self, cells, clear=False):
+        """ Queue all layers of some (x, y) cells, if they are in view
+
+        If clear is True, the cells are filled first, so nothing of what was
+        drawn before is left where the cells have no tiles now.  With a
+        colorkey, the cells are cleared when they are blitted instead.
+        """
+        view = self.view
+        cells = [i for i in set(cells) if view.collidepoint(i)]
+        if not cells:
+            return
+
+        if clear and not self.colorkey:
+            tw = self.data.tilewidth
+            th = self.data.tileheight
+            left, top = view.topleft
+            fill = self.buffer.fill
+            with self.lock:
+                for x, y, w, h in merge_cells(cells):
+                    fill((0, 0, 0),
+                         ((x - left) * tw, (y - top) * th, w * tw, h * th))
+            self.buffer_changed = True
+
+        layers = self._tile_layers()
+        self.update_queue([(x, y, l) for x, y in cells for l in layers])
+
 
 class ThreadedRenderer(BufferedRenderer):
     """ Off-screen tiling is handled in a thread
@@ -423,7 +1232,7 @@ class ThreadedRenderer(BufferedRenderer):
         self.thread.start()
 
     def update(self, dt=None):
-        pass
+        self.update_animations(dt)
 
     def flush(self):
         self.queue.join()
@@ -444,47 +1253,23 @@ class TileThread(threading.Thread):
 
     def run(self):
         r = self.renderer
-
-        tw = r.data.tilewidth
-        th = r.data.tileheight
-        get_tile = r.get_tile_image
-        colorkey = r.colorkey
         tile_queue = r.queue
         lock = r.lock
-        old_tiles = set()
-        old_view = None
 
         running = 1
 
         while running:
-            x, y, l = tile_queue.get()
-
-            # pyscroll may change these references to another object
-            # so, while we are defrencing them, we need to create new
-            # references if they change.
-            if old_view is not r.view:
-                fill = r.buffer.fill
-                blit = r.buffer.blit
-                ltw = r.view.left * tw
-                tth = r.view.top * th
-                old_tiles = set()
-
-            if colorkey:
-                tile = get_tile((x, y, l))
-                if tile:
-                    with lock:
-                        if l == 0:
-                            fill(colorkey, (x * tw - ltw, y * th - tth, tw, th))
-                        old_tiles.add((x, y, l))
-                        blit(tile, (x * tw - ltw, y * th - tth))
-                else:
-                    if (x, y, l - 1) not in old_tiles:
-                        with lock:
-                            fill(colorkey, (x * tw - ltw, y * th - tth, tw, th))
-            else:
-                tile = get_tile((x, y, l))
-                if tile:
-                    with lock:
-                        blit(tile, (x * tw - ltw, y * th - tth))
+            # take all the tiles that are waiting, so they can be drawn
+            # as one batch, like BufferedRenderer.update does
+            batch = [tile_queue.get()]
+            try:
+                while len(batch) < r.update_rate:
+                    batch.append(tile_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            with lock:
+                r.blit_tiles(batch)
 
-            tile_queue.task_done()
+            for i in batch:
+                tile_queue.task_done()
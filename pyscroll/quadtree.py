@@ -1,5 +1,5 @@
 """
-Two classes for quadtree collision detection.
+Classes for quadtree collision detection.
 
 A quadtree is used with pyscroll to detect overlapping tiles.
 """
@@ -129,3 +129,435 @@ class FastQuadTree(object):
             hits |= self.se.hit(rect)
 
         return hits
+
+
+class _QuadNode(object):
+    """ Node of a DynamicQuadTree
+    """
+
+    __slots__ = ['rect', 'depth', 'items', 'children']
+
+    def __init__(self, rect, depth):
+        self.rect = rect
+        self.depth = depth
+        self.items = dict()
+        self.children = None
+
+
+class DynamicQuadTree(object):
+    """A quad-tree that supports inserting, removing and moving objects.
+
+    Unlike FastQuadTree, the tree is not built once, and queries return the
+    objects that were stored, not tuples.  Objects must have a rect
+    (pygame.Rect) attribute and be hashable.
+
+    Each object is kept in the smallest node that contains its rect, and a
+    node is split into four when it holds more than max_items objects.  The
+    rect is copied when the object is inserted, so move() must be called
+    after the rect of an object changes.  Objects outside of the boundary are
+    kept in the root node.
+    """
+
+    def __init__(self, boundary, max_items=8, max_depth=8):
+        """Creates an empty dynamic quad-tree.
+
+        @param boundary:
+            The bounding rectangle of the area the objects will be in.
+
+        @param max_items:
+            Number of objects a node holds before it is split.
+
+        @param max_depth:
+            The maximum depth of the tree.
+        """
+        self.root = _QuadNode(Rect(boundary), 0)
+        self.max_items = max_items
+        self.max_depth = max_depth
+        self.nodes = dict()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, obj):
+        return obj in self.nodes
+
+    def __iter__(self):
+        return iter(list(self.nodes))
+
+    def insert(self, obj):
+        """Add an object to the tree.
+        """
+        rect = Rect(obj.rect)
+        node = self.root
+        while node.children is not None:
+            child = self._child_containing(node, rect)
+            if child is None:
+                break
+            node = child
+
+        node.items[obj] = rect
+        self.nodes[obj] = node
+
+        if (node.children is None and len(node.items) > self.max_items and
+                node.depth < self.max_depth):
+            self._split(node)
+
+    def remove(self, obj):
+        """Remove an object from the tree.
+        """
+        node = self.nodes.pop(obj)
+        del node.items[obj]
+
+    def move(self, obj):
+        """Update the position of an object after its rect has changed.
+        """
+        node = self.nodes[obj]
+        rect = Rect(obj.rect)
+
+        # if the object still fits in the same leaf, only update its rect
+        if node.children is None and node.rect.contains(rect):
+            node.items[obj] = rect
+        else:
+            self.remove(obj)
+            self.insert(obj)
+
+    def hit(self, rect):
+        """Returns a list of the objects that overlap a rectangle.
+        """
+        rect = Rect(rect)
+        colliderect = rect.colliderect
+        hits = list()
+        stack = [self.root]
+        pop = stack.pop
+        push = stack.extend
+        while stack:
+            node = pop()
+            hits.extend(obj for obj, r in node.items.items()
+                        if colliderect(r))
+            if node.children is not None:
+                push(child for child in node.children
+                     if colliderect(child.rect))
+        return hits
+
+    def hit_point(self, point):
+        """Returns a list of the objects that contain a point.
+        """
+        x, y = point
+        hits = list()
+        node = self.root
+        while node is not None:
+            hits.extend(obj for obj, r in node.items.items()
+                        if r.collidepoint(x, y))
+            children = node.children
+            node = None
+            if children is not None:
+                for child in children:
+                    if child.rect.collidepoint(x, y):
+                        node = child
+                        break
+        return hits
+
+    @staticmethod
+    def _child_containing(node, rect):
+        for child in node.children:
+            if child.rect.contains(rect):
+                return child
+        return None
+
+    def _split(self, node):
+        r = node.rect
+        hw = r.width // 2
+        hh = r.height // 2
+        depth = node.depth + 1
+        node.children = (
+            _QuadNode(Rect(r.left, r.top, hw, hh), depth),
+            _QuadNode(Rect(r.left + hw, r.top, r.width - hw, hh), depth),
+            _QuadNode(Rect(r.left, r.top + hh, hw, r.height - hh), depth),
+            _QuadNode(Rect(r.left + hw, r.top + hh,
+                           r.width - hw, r.height - hh), depth))
+
+        items = node.items
+        node.items = dict()
+        nodes = self.nodes
+        for obj, rect in items.items():
+            child = self._child_containing(node, rect)
+            if child is None:
+                child = node
+            child.items[obj] = rect
+            nodes[obj] = child
+
+
+class FlatQuadTree(object):
+    """A quad-tree stored as flat arrays, for answering many queries at once.
+
+    The items are split into quadrants the same way as FastQuadTree, but
+    the nodes are kept in numpy arrays instead of a graph of objects.
+    hit_many() walks the tree for all of the query rects together, one level
+    at a time, with vectorized numpy operations.
+
+    If the items are cells of a grid, like the tiles of a map, the tree is
+    not used: the cells that a query overlaps are found by dividing its
+    edges by the cell size.
+
+    Results are indices into the sequence of items that was passed in.
+
+    This class requires numpy.
+    """
+
+    def __init__(self, items, depth=4, boundary=None):
+        """Creates a flat quad-tree.
+
+        @param items:
+            A sequence of items to store in the quad-tree. Note that these
+            items must be a pygame.Rect or have a .rect attribute.
+
+        @param depth:
+            The maximum recursion depth.
+
+        @param boundary:
+            The bounding rectangle of all of the items in the quad-tree.
+        """
+        import numpy
+
+        self.items = [Rect(i) for i in items]
+
+        node_cx = list()
+        node_cy = list()
+        node_children = list()
+        node_start = list()
+        node_count = list()
+        node_items = list()
+
+        def build(indices, depth, boundary):
+            node = len(node_cx)
+            node_cx.append(0)
+            node_cy.append(0)
+            node_children.append([-1, -1, -1, -1])
+            node_start.append(len(node_items))
+
+            depth -= 1
+            if depth == 0 or not indices:
+                node_items.extend(indices)
+                node_count.append(len(indices))
+                return node
+
+            rects = self.items
+            if boundary:
+                boundary = Rect(boundary)
+            else:
+                boundary = Rect(rects[indices[0]]).unionall(
+                    [rects[i] for i in indices[1:]])
+
+            cx = node_cx[node] = boundary.centerx
+            cy = node_cy[node] = boundary.centery
+
+            here = list()
+            quadrants = ([], [], [], [])
+            for i in indices:
+                item = rects[i]
+                in_nw = item.left <= cx and item.top <= cy
+                in_sw = item.left <= cx and item.bottom >= cy
+                in_ne = item.right >= cx and item.top <= cy
+                in_se = item.right >= cx and item.bottom >= cy
+
+                if in_nw and in_ne and in_se and in_sw:
+                    here.append(i)
+                else:
+                    if in_nw: quadrants[0].append(i)
+                    if in_ne: quadrants[1].append(i)
+                    if in_se: quadrants[2].append(i)
+                    if in_sw: quadrants[3].append(i)
+
+            node_items.extend(here)
+            node_count.append(len(here))
+
+            bounds = ((boundary.left, boundary.top, cx, cy),
+                      (cx, boundary.top, boundary.right, cy),
+                      (cx, cy, boundary.right, boundary.bottom),
+                      (boundary.left, cy, cx, boundary.bottom))
+
+            for k in range(4):
+                if quadrants[k]:
+                    node_children[node][k] = build(quadrants[k], depth,
+                                                   bounds[k])
+            return node
+
+        build(list(range(len(self.items))), depth, boundary)
+
+        self.node_cx = numpy.array(node_cx, dtype=numpy.int64)
+        self.node_cy = numpy.array(node_cy, dtype=numpy.int64)
+        self.node_children = numpy.array(node_children, dtype=numpy.int64)
+        self.node_start = numpy.array(node_start, dtype=numpy.int64)
+        self.node_count = numpy.array(node_count, dtype=numpy.int64)
+        self.node_items = numpy.array(node_items, dtype=numpy.int64)
+        self.rects = numpy.array([tuple(i) for i in self.items],
+                                 dtype=numpy.int64).reshape(-1, 4)
+        self.grid = self._make_grid()
+
+    def _make_grid(self):
+        """Return array of item indices by cell, if the items are a grid
+
+        Returns None if the items are not all the same size, are not
+        aligned to one grid, or if two items are in the same cell.
+        """
+        import numpy
+
+        rects = self.rects
+        if not len(rects):
+            return None
+
+        width, height = rects[0, 2], rects[0, 3]
+        if (width <= 0 or height <= 0 or (rects[:, 2] != width).any() or
+                (rects[:, 3] != height).any()):
+            return None
+
+        self.grid_origin = rects[:, 0].min(), rects[:, 1].min()
+        columns, x_rest = numpy.divmod(rects[:, 0] - self.grid_origin[0],
+                                       width)
+        rows, y_rest = numpy.divmod(rects[:, 1] - self.grid_origin[1],
+                                    height)
+        if x_rest.any() or y_rest.any():
+            return None
+
+        grid = numpy.full((rows.max() + 1, columns.max() + 1), -1,
+                          dtype=numpy.int64)
+        grid[rows, columns] = numpy.arange(len(rects))
+        if (grid >= 0).sum() != len(rects):
+            return None
+        return grid
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def hit(self, rect):
+        """Returns the set of items that overlap a bounding rectangle.
+
+        The items are returned as tuples, like FastQuadTree.hit.
+        """
+        items = self.items
+        return set(tuple(items[i]) for i in self.hit_many([rect])[0])
+
+    def hit_many(self, rects):
+        """Returns the indices of the items that overlap each rect.
+
+        @param rects:
+            A sequence of rects, or a numpy array of shape (n, 4) holding
+            x, y, width and height for each query rect.
+
+        Returns a list with one sorted numpy array of item indices for each
+        query rect.
+        """
+        import numpy
+
+        queries = numpy.asarray([tuple(i) for i in rects]
+                                if not isinstance(rects, numpy.ndarray)
+                                else rects, dtype=numpy.int64).reshape(-1, 4)
+        if self.grid is not None:
+            return self._hit_grid(queries)
+
+        count = len(queries)
+        ql = queries[:, 0]
+        qt = queries[:, 1]
+        qr = ql + queries[:, 2]
+        qb = qt + queries[:, 3]
+        q_valid = (queries[:, 2] > 0) & (queries[:, 3] > 0)
+
+        il = self.rects[:, 0]
+        it = self.rects[:, 1]
+        ir = il + self.rects[:, 2]
+        ib = it + self.rects[:, 3]
+        i_valid = (self.rects[:, 2] > 0) & (self.rects[:, 3] > 0)
+
+        # (query, node) pairs still to visit, starting at the root
+        pair_q = numpy.arange(count)
+        pair_n = numpy.zeros(count, dtype=numpy.int64)
+        hit_q = list()
+        hit_i = list()
+
+        while len(pair_q):
+            # test the items stored in each visited node
+            counts = self.node_count[pair_n]
+            total = counts.sum()
+            if total:
+                ends = numpy.cumsum(counts)
+                offsets = numpy.arange(total) - numpy.repeat(ends - counts,
+                                                             counts)
+                q = numpy.repeat(pair_q, counts)
+                i = self.node_items[numpy.repeat(self.node_start[pair_n],
+                                                 counts) + offsets]
+                mask = ((ql[q] < ir[i]) & (qr[q] > il[i]) &
+                        (qt[q] < ib[i]) & (qb[q] > it[i]) &
+                        q_valid[q] & i_valid[i])
+                hit_q.append(q[mask])
+                hit_i.append(i[mask])
+
+            # descend into the quadrants each query overlaps
+            cx = self.node_cx[pair_n]
+            cy = self.node_cy[pair_n]
+            children = self.node_children[pair_n]
+            left = ql[pair_q] <= cx
+            right = qr[pair_q] >= cx
+            top = qt[pair_q] <= cy
+            bottom = qb[pair_q] >= cy
+            next_q = list()
+            next_n = list()
+            for k, overlaps in enumerate((left & top, right & top,
+                                          right & bottom, left & bottom)):
+                mask = overlaps & (children[:, k] >= 0)
+                next_q.append(pair_q[mask])
+                next_n.append(children[mask, k])
+            pair_q = numpy.concatenate(next_q)
+            pair_n = numpy.concatenate(next_n)
+
+        if not hit_q:
+            return [numpy.zeros(0, dtype=numpy.int64) for i in range(count)]
+
+        # items may be stored in more than one quadrant, so remove doubles
+        # and group the hits by query
+        n = max(len(self.items), 1)
+        keys = numpy.unique(numpy.concatenate(hit_q) * n +
+                            numpy.concatenate(hit_i))
+        q = keys // n
+        i = keys % n
+        splits = numpy.cumsum(numpy.bincount(q, minlength=count))[:-1]
+        return numpy.split(i, splits)
+
+    def _hit_grid(self, queries):
+        """Returns the indices of the grid cells that overlap each query
+        """
+        import numpy
+
+        if not len(queries):
+            return list()
+
+        grid = self.grid
+        rows, columns = grid.shape
+        width, height = self.rects[0, 2], self.rects[0, 3]
+        x = queries[:, 0] - self.grid_origin[0]
+        y = queries[:, 1] - self.grid_origin[1]
+        valid = (queries[:, 2] > 0) & (queries[:, 3] > 0)
+
+        # first and last + 1 cell that each query overlaps
+        left = numpy.clip(x // width, 0, columns)
+        top = numpy.clip(y // height, 0, rows)
+        right = numpy.clip(-(-(x + queries[:, 2]) // width), 0, columns)
+        bottom = numpy.clip(-(-(y + queries[:, 3]) // height), 0, rows)
+        spans = numpy.where(valid, numpy.maximum(right - left, 0), 0)
+        heights = numpy.where(valid, numpy.maximum(bottom - top, 0), 0)
+
+        # every (query, cell) pair, row by row
+        counts = spans * heights
+        total = counts.sum()
+        query = numpy.repeat(numpy.arange(len(queries)), counts)
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) -
+                                                     counts, counts)
+        span = numpy.maximum(spans[query], 1)
+        cells = grid[top[query] + offsets // span,
+                     left[query] + offsets % span]
+
+        found = cells >= 0
+        query = query[found]
+        cells = cells[found]
+        order = numpy.lexsort((cells, query))
+        splits = numpy.cumsum(numpy.bincount(query, minlength=len(queries)))
+        return numpy.split(cells[order], splits[:-1])
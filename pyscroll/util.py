@@ -1,91 +1,244 @@
 import pygame
-import pygame.gfxdraw
+import itertools
+from itertools import product
+from six.moves import range
 
 __all__ = ['PyscrollGroup', 'draw_shapes']
 
 
-def draw_shapes(tmx_data):
-    """ create a new tile layer from a shape layer
-    totally not working
-    """
-    import itertools
-    import pytmx
-    import array
+def draw_shapes(tmx_data, colorkey=(255, 0, 255), name='shapes'):
+    """ Bake the visible object layers of a pytmx map into a new tile layer
 
-    cache = []
+    The objects are drawn once, a row of tiles at a time, the same way
+    BufferedRenderer draws them, so the new layer looks the same as the
+    objects did.  The result is cut into tiles, and tiles that look the
+    same share one image: each tile is hashed and looked up in a dict, so
+    finding a duplicate is O(1).  Tiles with nothing drawn on them are left
+    empty.
 
-    def check_cache(surface, gid):
-        def compare(s0, s1):
-            return s0 == s1
+    The new layer is added on top of the other layers, where objects are
+    drawn, and the baked object layers are hidden so the renderer does not
+    draw them again.  Returns the number of the new layer.
 
-        for other in cache:
-            h = hash(pygame.image.tostring(surface, 'RGB'))
-            if compare(surface, other[0]):
-                return other
+    Requires PyTMX 3.x or newer.
+    """
+    import hashlib
+    import pytmx
+    from xml.etree import ElementTree
+    from .data import TiledMapData
+    from .pyscroll import BufferedRenderer
 
-        cache.append((surface, gid))
-        return surface, gid
+    data = TiledMapData(tmx_data, deduplicate=False)
+    tw, th = tmx_data.tilewidth, tmx_data.tileheight
+    width, height = tmx_data.width, tmx_data.height
+    object_layers = list(data.visible_object_layers)
 
-    colorkey = (255, 0, 255)
+    # a layer of empty tiles, made from xml like a layer read from a map
+    node = ElementTree.fromstring(
+        '<layer name="{0}" width="{1}" height="{2}">'
+        '<data encoding="csv">{3}</data></layer>'.format(
+            name, width, height, ','.join(['0'] * (width * height))))
+    layer = pytmx.TiledTileLayer(tmx_data, node)
 
-    size = (int(tmx_data.width * tmx_data.tilewidth),
-            int(tmx_data.height * tmx_data.tileheight))
+    # renderer that is one row of tiles tall, used only to draw objects
+    renderer = BufferedRenderer(data, (width * tw, th), colorkey, padding=0,
+                                prerender_limit=0)
+    buff = renderer.buffer
+    tostring = pygame.image.tostring
 
-    tw, th = tmx_data.tilewidth, tmx_data.tileheight
+    def digest(surface):
+        return hashlib.sha1(tostring(surface, 'RGB')).digest()
 
-    surface = pygame.Surface(size)
-    surface.fill(colorkey)
-    surface.set_colorkey(colorkey)
-
-    TEXTURE = tmx_data.images[2]
-
-    for layer in tmx_data.objectgroups:
-        draw(surface, tmx_data, *layer)
-        for o in layer:
-            if hasattr(o, 'points'):
-                if o.closed:
-                    pygame.gfxdraw.textured_polygon(surface, o.points, TEXTURE,
-                                                    tw, th)
-                else:
-                    pygame.draw.lines(surface, (255, 128, 128), o.closed,
-                                      o.points, 2)
-            elif o.gid:
-                tile = tmx_data.getTileImageByGid(o.gid)
-                if tile:
-                    surface.blit(tile, (o.x, o.y))
-            else:
-                pygame.draw.rect(surface, (255, 128, 128),
-                                 (o.x, o.y, o.width, o.height), 2)
+    empty = pygame.Surface((tw, th))
+    empty.fill(colorkey)
+    gids = {digest(empty): 0}
+    images = tmx_data.images
 
-        p = itertools.product(range(tmx_data.height),
-                              range(tmx_data.width))
+    for y in range(height):
+        renderer.view.topleft = (0, y)
+        buff.fill(colorkey)
+        renderer.draw_objects()
 
-        new_layer = pytmx.TiledLayer()
-        new_layer.visible = 1
-        new_layer.data = tuple(array.array('H', [0] * tmx_data.width)
-                               for i in range(tmx_data.height))
+        for x in range(width):
+            tile = buff.subsurface((x * tw, 0, tw, th))
+            key = digest(tile)
+            try:
+                gid = gids[key]
+            except KeyError:
+                tile = tile.copy()
+                tile.set_colorkey(colorkey, pygame.RLEACCEL)
+                gid = gids[key] = len(images)
+                images.append(tile)
 
-        tmx_data.addTileLayer(new_layer)
+            layer.data[y][x] = gid
 
-        for y, x in p:
-            gid = len(tmx_data.images)
-            original = surface.subsurface(((x * tw, y * th), (tw, th)))
-            tile, gid = check_cache(original, gid)
-            if original is tile:
-                gid = tmx_data.register_gid(gid)
-                tile = tile.convert()
-                tmx_data.images.append(tile)
+    for object_layer in object_layers:
+        object_layer.visible = False
 
-            new_layer.data[y][x] = gid
+    tmx_data.add_layer(layer)
+    return len(tmx_data.layers) - 1
 
 
 class PyscrollGroup(pygame.sprite.LayeredUpdates):
     """ Layered Group with ability to center sprites and scrolling map
+
+    Sprites are kept in a spatial hash of their map positions, so drawing
+    only considers sprites that are inside the view.  A sprite is re-hashed
+    when its rect has changed since the last draw.
+
+    cell_size is the size of a hash cell in pixels.  It should be larger
+    than most sprites, but smaller than the screen.
+
+    If dirty_updates is True, draw works like pygame's LayeredDirty while the
+    camera is idle: only the areas under the old and new rects of sprites
+    that moved or changed image are redrawn, and draw returns just those
+    rects for display.update.  A sprite that changes its image in place
+    (without assigning a new surface) will not be noticed.
+
+    If y_sort is True, sprites in the same layer are drawn ordered by the
+    bottom of their rect, so sprites lower on the screen cover the ones
+    behind them.  Layers still come first, so tiles of higher layers cover
+    the sprites as usual.  The order from the last draw is reused, so when
+    sprites move a little, keeping them sorted is nearly linear.
     """
     def __init__(self, *args, **kwargs):
+        # add_internal is called by LayeredUpdates.__init__, so the
+        # hash must exist before the base class is initialized
+        self._cell_size = int(kwargs.get('cell_size', 128))
+        self._spatial_hash = dict()
+        self._sprite_rects = dict()
+        self._sprite_cells = dict()
+        self._draw_keys = dict()
+        self._serial = itertools.count()
+        self._dirty_updates = kwargs.get('dirty_updates', False)
+        self._drawn = dict()
+        self._y_sort = kwargs.get('y_sort', False)
+        self._visible = list()
+
         pygame.sprite.LayeredUpdates.__init__(self, *args, **kwargs)
         self._map_layer = kwargs.get('map_layer')
 
+    def add_internal(self, sprite, layer=None):
+        pygame.sprite.LayeredUpdates.add_internal(self, sprite, layer)
+        self._set_draw_key(sprite, next(self._serial))
+        self._hash_sprite(sprite)
+
+    def remove_internal(self, sprite):
+        # LayeredUpdates adds sprite.rect as a lost rect, but here it is in
+        # map coordinates; only the last rect drawn on the screen is lost
+        old_rect = self.spritedict[sprite]
+        lost = len(self.lostsprites)
+        pygame.sprite.LayeredUpdates.remove_internal(self, sprite)
+        del self.lostsprites[lost:]
+        if sprite in self._drawn:
+            del self._drawn[sprite]
+            self.lostsprites.append(old_rect)
+        self._unhash_sprite(sprite)
+        del self._sprite_rects[sprite]
+        del self._draw_keys[sprite]
+
+    def change_layer(self, sprite, new_layer):
+        pygame.sprite.LayeredUpdates.change_layer(self, sprite, new_layer)
+
+        # change_layer puts the sprite last in its new layer
+        self._set_draw_key(sprite, next(self._serial))
+
+    def _set_draw_key(self, sprite, serial):
+        """ Set the key used to order sprites when drawing
+
+        serial breaks ties, so sprites with the same layer (and bottom, when
+        y sorting) are drawn in the order they were added.
+        """
+        layer = self._spritelayers[sprite]
+        if self._y_sort:
+            self._draw_keys[sprite] = (layer, sprite.rect.bottom, serial)
+        else:
+            self._draw_keys[sprite] = (layer, serial)
+
+    def _cells_for_rect(self, rect):
+        """ Return the hash cells that a rect touches
+        """
+        cs = self._cell_size
+        left, top = rect.left // cs, rect.top // cs
+        right = max(rect.right - 1, rect.left) // cs
+        bottom = max(rect.bottom - 1, rect.top) // cs
+        return tuple(product(range(left, right + 1), range(top, bottom + 1)))
+
+    def _hash_sprite(self, sprite):
+        """ Place sprite in the cells touched by its current rect
+        """
+        self._unhash_sprite(sprite)
+        rect = pygame.Rect(sprite.rect)
+        cells = self._cells_for_rect(rect)
+        spatial_hash = self._spatial_hash
+        for cell in cells:
+            try:
+                spatial_hash[cell].add(sprite)
+            except KeyError:
+                spatial_hash[cell] = {sprite}
+        self._sprite_rects[sprite] = rect
+        self._sprite_cells[sprite] = cells
+        if self._y_sort:
+            self._set_draw_key(sprite, self._draw_keys[sprite][-1])
+
+    def _unhash_sprite(self, sprite):
+        spatial_hash = self._spatial_hash
+        for cell in self._sprite_cells.pop(sprite, ()):
+            bucket = spatial_hash[cell]
+            bucket.discard(sprite)
+            if not bucket:
+                del spatial_hash[cell]
+
+    def rehash(self):
+        """ Update the spatial hash for sprites that have moved
+
+        This is called automatically when drawing.
+        """
+        moved = [spr for spr, rect in self._sprite_rects.items()
+                 if spr.rect != rect]
+        for spr in moved:
+            self._hash_sprite(spr)
+
+    def get_sprites_in_rect(self, rect):
+        """ Return sprites that intersect a rect in map coordinates
+
+        The sprites are returned in the order they would be drawn.  The
+        spatial hash is not updated; call rehash() first if sprites have
+        moved since the last draw.
+        """
+        sprites = list(self._find_sprites(rect))
+        sprites.sort(key=self._draw_keys.__getitem__)
+        return sprites
+
+    def _find_sprites(self, rect):
+        """ Return set of sprites that intersect a rect in map coordinates
+        """
+        rect = pygame.Rect(rect)
+        spatial_hash = self._spatial_hash
+        found = set()
+        for cell in self._cells_for_rect(rect):
+            try:
+                found.update(spatial_hash[cell])
+            except KeyError:
+                pass
+
+        colliderect = rect.colliderect
+        return {spr for spr in found if colliderect(spr.rect)}
+
+    def _get_visible_sprites(self, rect):
+        """ Return sprites inside the view, in the order they are drawn
+
+        Sprites still visible keep their order from the last draw and new
+        ones are added to the end, so the list is nearly sorted already.
+        """
+        found = self._find_sprites(rect)
+        visible = [spr for spr in self._visible if spr in found]
+        found.difference_update(visible)
+        visible.extend(found)
+        visible.sort(key=self._draw_keys.__getitem__)
+        self._visible = visible
+        return visible
+
     def update(self, dt):
         pygame.sprite.LayeredUpdates.update(self, dt)
         self._map_layer.update(dt)
@@ -102,21 +255,59 @@ class PyscrollGroup(pygame.sprite.LayeredUpdates):
         """ Draw all sprites and map onto the surface
 
         Group.draw(surface): return None
-        Draws all of the member sprites onto the given surface.
+        Draws the member sprites that are inside the view onto the given
+        surface.
         """
         xx = -self._map_layer.old_x + self._map_layer.half_width
         yy = -self._map_layer.old_y + self._map_layer.half_height
+        rect = surface.get_rect()
+
+        self.rehash()
 
         new_surfaces = []
         spritedict = self.spritedict
         gl = self.get_layer_of_sprite
         new_surfaces_append = new_surfaces.append
+        visible = self._get_visible_sprites(rect.move(-xx, -yy))
 
-        for spr in self.sprites():
+        if not self._dirty_updates:
+            for spr in visible:
+                new_rect = spr.rect.move(xx, yy)
+                new_surfaces_append((spr.image, new_rect, gl(spr)))
+                spritedict[spr] = new_rect
+
+            return self._map_layer.draw(surface, rect, new_surfaces)
+
+        # collect the areas under the old and new rects of sprites that
+        # moved, changed image, or left the view since the last draw.  the
+        # map layer joins the areas that overlap.
+        areas = self.lostsprites
+        self.lostsprites = []
+        areas_append = areas.append
+        old_drawn = self._drawn
+        drawn = dict()
+
+        for spr in visible:
+            image = spr.image
             new_rect = spr.rect.move(xx, yy)
-            new_surfaces_append((spr.image, new_rect, gl(spr)))
+            new_surfaces_append((image, new_rect, gl(spr)))
+            drawn[spr] = image
+
+            old_image = old_drawn.pop(spr, None)
+            if old_image is None:
+                areas_append(new_rect)
+            else:
+                old_rect = spritedict[spr]
+                if old_rect != new_rect or old_image is not image:
+                    areas_append(new_rect)
+                    areas_append(old_rect)
             spritedict[spr] = new_rect
 
-        _dirty = self._map_layer.draw(surface, surface.get_rect(), new_surfaces)
+        # sprites drawn last time that are not in the view anymore
+        init_rect = self._init_rect
+        for spr in old_drawn:
+            areas_append(spritedict[spr])
+            spritedict[spr] = init_rect
 
-        return _dirty
+        self._drawn = drawn
+        return self._map_layer.draw(surface, rect, new_surfaces, areas)
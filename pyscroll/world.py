@@ -0,0 +1,300 @@
+"""
+Data class that joins many maps on a grid into one large world.
+
+Each map is a chunk of the world, and all chunks are the same size in tiles.
+Maps are loaded in a thread as the view of the renderer gets near them, and
+are dropped when it moves far away, so only a few are in memory at once.
+"""
+
+import logging
+import threading
+from six.moves import queue, range
+
+__all__ = ['WorldData']
+
+logger = logging.getLogger(__name__)
+
+
+class WorldData(object):
+    """ Data class for a world made of maps placed on a grid
+
+    loader is called with a (column, row) tuple and returns the data class
+    for that chunk of the world, like TiledMapData, or None if there is no
+    map there.  It is called in a thread, except for the start chunk, which
+    is loaded when the world is created.  The start map sets the size of the
+    chunks, the size of the tiles and the tile layers that are drawn.  Every
+    map should have the same tile size and layers.
+
+    Renderers call update_view before they draw.  Maps within load_margin
+    tiles of the view are loaded in the background; until a map is loaded
+    its cells are empty, and when it is loaded the listeners are told to
+    draw its cells.  Maps further than twice load_margin from the view are
+    unloaded, and the listeners are told that their cells are empty.  With
+    many renderers, maps are kept near the view of the one that drew last.
+
+    Positions in tile layers are world positions.  Gids are (chunk, gid)
+    tuples, so animations of every map can be played.  Objects of the maps
+    are not drawn.
+    """
+
+    def __init__(self, loader, columns, rows, start=(0, 0), load_margin=None):
+        self.loader = loader
+        self.columns = columns
+        self.rows = rows
+        self.maps = dict()
+        self.tile_listeners = list()
+        self.animations = dict()
+        self.animated_tiles = dict()
+        self._map_animations = dict()
+        self._listeners = dict()
+        self._pending = set()
+        self._missing = set()
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._thread = None
+
+        start = tuple(start)
+        first = loader(start)
+        self.chunk_width = first.width
+        self.chunk_height = first.height
+        self.tilewidth = first.tilewidth
+        self.tileheight = first.tileheight
+        self.tile_layers = list(first.visible_tile_layers)
+
+        if load_margin is None:
+            load_margin = max(self.chunk_width, self.chunk_height) // 2
+        self.load_margin = load_margin
+
+        self._add_map(start, first)
+
+    @property
+    def width(self):
+        return self.columns * self.chunk_width
+
+    @property
+    def height(self):
+        return self.rows * self.chunk_height
+
+    @property
+    def visible_layers(self):
+        return iter(self.tile_layers)
+
+    @property
+    def visible_tile_layers(self):
+        return iter(self.tile_layers)
+
+    @property
+    def visible_object_layers(self):
+        return iter(())
+
+    def get_map(self, position):
+        """ Return data class and local position for a world position
+
+        The data class is None if the map there is not loaded.
+        """
+        x, y, l = position
+        column, x = divmod(x, self.chunk_width)
+        row, y = divmod(y, self.chunk_height)
+        return self.maps.get((column, row)), (x, y, l)
+
+    def get_tile_image(self, position):
+        """ Return a surface for this position.
+
+        Returns None if the map at this position is not loaded.
+        position is x, y, layer tuple
+        """
+        data, local = self.get_map(position)
+        if data is None:
+            return None
+        return data.get_tile_image(local)
+
+    def get_tile_properties(self, position):
+        data, local = self.get_map(position)
+        if data is None:
+            return None
+        return data.get_tile_properties(local)
+
+    def get_tile_opacity(self, position):
+        from .data import TILE_EMPTY
+
+        data, local = self.get_map(position)
+        if data is None:
+            return TILE_EMPTY
+        return data.get_tile_opacity(local)
+
+    def get_tile_image_by_gid(self, gid):
+        """ Return surface for a (chunk, gid) tuple
+        """
+        chunk, gid = gid
+        data = self.maps.get(chunk)
+        if data is None:
+            return None
+        return data.get_tile_image_by_gid(gid)
+
+    def set_tiles(self, tiles):
+        """ Change many tiles at once
+
+        tiles is an iterable of (x, y, layer, gid) tuples, in world positions
+        and with gids of the map at that position.  Tiles of maps that are
+        not loaded are not changed.  Returns the list of positions that
+        changed.
+        """
+        chunks = dict()
+        for x, y, l, gid in tiles:
+            chunk = x // self.chunk_width, y // self.chunk_height
+            if chunk in self.maps:
+                chunks.setdefault(chunk, list()).append(
+                    (x % self.chunk_width, y % self.chunk_height, l, gid))
+
+        # listeners are called by each map, see _map_changed
+        changed = list()
+        for chunk, chunk_tiles in chunks.items():
+            left = chunk[0] * self.chunk_width
+            top = chunk[1] * self.chunk_height
+            changed.extend((x + left, y + top, l) for x, y, l in
+                           self.maps[chunk].set_tiles(chunk_tiles))
+        return changed
+
+    def set_tile(self, x, y, layer, gid):
+        return self.set_tiles([(x, y, layer, gid)])
+
+    def update_view(self, view):
+        """ Load maps near a view and unload the ones far from it
+
+        view is a rect in tiles.  Maps that have been loaded since the last
+        call are added here, so listeners are only called from the thread
+        that calls this.
+        """
+        margin = self.load_margin
+        near = self.chunks_in_rect(view.inflate(margin * 2, margin * 2))
+        keep = self.chunks_in_rect(view.inflate(margin * 4, margin * 4))
+
+        while True:
+            try:
+                chunk, data = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._pending.discard(chunk)
+            if data is None:
+                self._missing.add(chunk)
+            elif chunk in keep:
+                self._add_map(chunk, data)
+
+        for chunk in near:
+            if (chunk not in self.maps and chunk not in self._pending and
+                    chunk not in self._missing):
+                self._pending.add(chunk)
+                self._requests.put(chunk)
+                self._start_thread()
+
+        for chunk in list(self.maps):
+            if chunk not in keep:
+                self._remove_map(chunk)
+
+    def chunks_in_rect(self, rect):
+        """ Return set of (column, row) chunks that a rect in tiles touches
+        """
+        left = max(rect.left // self.chunk_width, 0)
+        top = max(rect.top // self.chunk_height, 0)
+        right = min((rect.right - 1) // self.chunk_width, self.columns - 1)
+        bottom = min((rect.bottom - 1) // self.chunk_height, self.rows - 1)
+        return set((column, row) for column in range(left, right + 1)
+                   for row in range(top, bottom + 1))
+
+    def _start_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._load_maps)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _load_maps(self):
+        """ Load chunks from the request queue, forever
+        """
+        while True:
+            chunk = self._requests.get()
+            try:
+                data = self.loader(chunk)
+            except Exception:
+                logger.exception('cannot load chunk %s', chunk)
+                data = None
+            self._results.put((chunk, data))
+
+    def _add_map(self, chunk, data):
+        def changed(positions):
+            self._map_changed(chunk, positions)
+
+        self.maps[chunk] = data
+        listeners = getattr(data, 'tile_listeners', None)
+        if listeners is not None:
+            listeners.append(changed)
+            self._listeners[chunk] = changed
+
+        self._build_animations()
+        self._notify(self._chunk_cells(chunk))
+
+    def _remove_map(self, chunk):
+        data = self.maps.pop(chunk)
+        changed = self._listeners.pop(chunk, None)
+        if changed is not None:
+            data.tile_listeners.remove(changed)
+
+        # renderers read the new animation tables when they are notified
+        self._build_animations()
+        self._notify(self._chunk_cells(chunk))
+
+    def _chunk_cells(self, chunk):
+        """ Return list of (x, y, layer) positions of every cell of a chunk
+        """
+        left = chunk[0] * self.chunk_width
+        top = chunk[1] * self.chunk_height
+        layer = self.tile_layers[0] if self.tile_layers else 0
+        return [(x, y, layer)
+                for y in range(top, top + self.chunk_height)
+                for x in range(left, left + self.chunk_width)]
+
+    def _map_changed(self, chunk, positions):
+        """ Pass changes of a map on to the listeners, in world positions
+        """
+        left = chunk[0] * self.chunk_width
+        top = chunk[1] * self.chunk_height
+        data = self.maps[chunk]
+        if getattr(data, 'animations', None) is not self._map_animations.get(
+                chunk):
+            # the map was reloaded
+            self._build_animations()
+        else:
+            # the dict is shared with renderers, so change it in place
+            animated = getattr(data, 'animated_tiles', dict())
+            for x, y, l in positions:
+                self.animated_tiles.pop((x + left, y + top, l), None)
+                if (x, y, l) in animated:
+                    self.animated_tiles[(x + left, y + top, l)] = \
+                        (chunk, animated[(x, y, l)])
+
+        self._notify([(x + left, y + top, l) for x, y, l in positions])
+
+    def _notify(self, positions):
+        for listener in list(self.tile_listeners):
+            listener(positions)
+
+    def _build_animations(self):
+        """ Collect the animations of the loaded maps, with (chunk, gid) gids
+
+        New dicts are made, so renderers can tell that they have changed.
+        """
+        animations = dict()
+        animated_tiles = dict()
+        self._map_animations = dict()
+        for chunk, data in self.maps.items():
+            self._map_animations[chunk] = getattr(data, 'animations', None)
+            left = chunk[0] * self.chunk_width
+            top = chunk[1] * self.chunk_height
+            for gid, frames in getattr(data, 'animations', dict()).items():
+                animations[(chunk, gid)] = tuple(((chunk, frame), duration)
+                                                 for frame, duration in frames)
+            for (x, y, l), gid in getattr(data, 'animated_tiles',
+                                          dict()).items():
+                animated_tiles[(x + left, y + top, l)] = (chunk, gid)
+
+        self.animations = animations
+        self.animated_tiles = animated_tiles
@@ -0,0 +1,34 @@
+"""
+Things shared by the tests: the maps, a display, and whole-map renders.
+"""
+import os
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+import pyscroll
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DESERT = os.path.join(HERE, 'desert.tmx')
+GRASSLANDS = os.path.join(HERE, os.pardir, 'tutorial', 'code', 'data',
+                          'grasslands.tmx')
+
+
+def render_whole(data):
+    """ Return RGB bytes of the whole map, drawn by a BufferedRenderer
+    """
+    size = data.width * data.tilewidth, data.height * data.tileheight
+    renderer = pyscroll.BufferedRenderer(data, size, padding=0)
+    renderer.redraw()
+    return pygame.image.tostring(renderer.buffer, 'RGB')
+
+
+class DisplayTestCase(unittest.TestCase):
+    """ Test case with a display, which pytmx needs to load maps
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        pygame.init()
+        pygame.display.set_mode((10, 10))
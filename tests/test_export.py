@@ -0,0 +1,59 @@
+"""
+Check that a map exported in strips is the same as the map rendered whole.
+
+Run with python -m unittest discover tests
+"""
+import io
+import unittest
+
+from helpers import DESERT, DisplayTestCase, render_whole
+
+import pygame
+import pytmx
+import pyscroll
+from pyscroll.export import export_map
+
+# (strip_rows, chunk_columns)
+STRIPS = [(4, 64), (3, 7), (1, 1), (5, 13)]
+
+
+class TestExport(DisplayTestCase):
+
+    def load(self):
+        tmx = pytmx.load_pygame(DESERT)
+        # shapes cross the seams of the strips
+        for layer in tmx.layers:
+            layer.visible = True
+        return tmx
+
+    def render_strips(self, data, strip_rows, chunk_columns):
+        fileobj = io.BytesIO()
+        export_map(data, fileobj, strip_rows=strip_rows,
+                   chunk_columns=chunk_columns)
+        fileobj.seek(0)
+        return pygame.image.tostring(pygame.image.load(fileobj, 'map.png'),
+                                     'RGB')
+
+    def check(self, data):
+        whole = render_whole(data)
+        for strip_rows, chunk_columns in STRIPS:
+            strips = self.render_strips(data, strip_rows, chunk_columns)
+            self.assertTrue(strips == whole,
+                            'strips of %d rows, %d columns differ' %
+                            (strip_rows, chunk_columns))
+
+    def test_shapes(self):
+        self.check(pyscroll.TiledMapData(self.load()))
+
+    def test_large_tiles(self):
+        # tiles cover the cells to the right and below theirs
+        tmx = self.load()
+        tmx.tilewidth = tmx.tileheight = 16
+        data = pyscroll.TiledMapData(tmx)
+        data.set_tiles((x, y, 0, 0) for y in range(data.height)
+                       for x in range(data.width) if (x + y) % 3)
+        self.check(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Check that a renderer draws a map the same way after it is given new data,
+and that dirty areas are joined before they are drawn.
+
+Run with python -m unittest discover tests
+"""
+import unittest
+
+from helpers import GRASSLANDS, DisplayTestCase
+
+import pygame
+import pytmx
+import pyscroll
+
+
+class TestSetData(DisplayTestCase):
+
+    def render(self, renderer):
+        renderer.redraw()
+        return pygame.image.tostring(renderer.buffer, 'RGB')
+
+    def test_set_data(self):
+        first = pyscroll.TiledMapData(pytmx.load_pygame(GRASSLANDS))
+        size = first.width * first.tilewidth, first.height * first.tileheight
+        renderer = pyscroll.BufferedRenderer(first, size, padding=0)
+        self.render(renderer)
+
+        # the same layers, with nothing over the ground
+        second = pyscroll.TiledMapData(pytmx.load_pygame(GRASSLANDS))
+        layers = list(second.visible_tile_layers)
+        second.set_tiles((x, y, l, 0) for l in layers[1:]
+                         for y in range(second.height)
+                         for x in range(second.width))
+
+        renderer.set_data(second)
+        fresh = pyscroll.BufferedRenderer(second, size, padding=0)
+        self.assertTrue(self.render(renderer) == self.render(fresh),
+                        'renderer differs from a new one after set_data')
+
+
+class TestDirtyAreas(DisplayTestCase):
+
+    def make_group(self, tmx, **kwargs):
+        data = pyscroll.TiledMapData(tmx)
+        renderer = pyscroll.BufferedRenderer(data, (200, 150))
+        return pyscroll.PyscrollGroup(map_layer=renderer, default_layer=0,
+                                      **kwargs)
+
+    def test_no_overlap(self):
+        tmx = pytmx.load_pygame(GRASSLANDS)
+        plain = self.make_group(tmx)
+        dirty = self.make_group(tmx, dirty_updates=True)
+        image = pygame.Surface((16, 16), pygame.SRCALPHA)
+        image.fill((255, 0, 0, 100))
+
+        # sprites in a cluster, so the areas of different sprites overlap
+        pairs = list()
+        for i in range(12):
+            pair = list()
+            for group in plain, dirty:
+                sprite = pygame.sprite.Sprite()
+                sprite.image = image
+                sprite.rect = image.get_rect(topleft=(300 + i * 5, 300))
+                group.add(sprite)
+                pair.append(sprite)
+            pairs.append(pair)
+
+        expected = pygame.Surface((200, 150))
+        surface = pygame.Surface((200, 150))
+        for frame in range(6):
+            for group in plain, dirty:
+                group.center((320, 310))
+            for sprites in pairs[::2]:
+                for sprite in sprites:
+                    sprite.rect.move_ip(3, 1)
+            if frame == 3:
+                plain.remove(pairs[1][0])
+                dirty.remove(pairs[1][1])
+
+            plain.draw(expected)
+            rects = dirty.draw(surface)
+            for i, rect in enumerate(rects):
+                self.assertEqual(rect.collidelist(rects[i + 1:]), -1,
+                                 'dirty areas overlap')
+            self.assertTrue(pygame.image.tostring(surface, 'RGB') ==
+                            pygame.image.tostring(expected, 'RGB'),
+                            'dirty updates differ from a full draw')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+"""
+Check that shapes baked into tiles look the same as shapes drawn by the map.
+
+Run with python -m unittest discover tests
+"""
+import unittest
+
+from helpers import DESERT, DisplayTestCase, render_whole
+
+import pytmx
+import pyscroll
+
+
+class TestDrawShapes(DisplayTestCase):
+
+    def test_same_as_objects(self):
+        tmx = pytmx.load_pygame(DESERT)
+        for layer in tmx.layers:
+            layer.visible = True
+        data = pyscroll.TiledMapData(tmx)
+        objects = render_whole(data)
+
+        layer = pyscroll.draw_shapes(tmx)
+        self.assertEqual(layer, len(tmx.layers) - 1)
+        self.assertEqual(list(data.visible_object_layers), [])
+        self.assertTrue(render_whole(data) == objects,
+                        'baked shapes differ from drawn objects')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -106,16 +106,14 @@ class QuestGame(object):
         # load data from pytmx
         tmx_data = pytmx.load_pygame(self.filename)
 
-        # setup level geometry with simple pygame rects, loaded from pytmx
-        self.walls = list()
-        for object in tmx_data.objects:
-            self.walls.append(pygame.Rect(
-                object.x, object.y,
-                object.width, object.height))
-
         # create new data source for pyscroll
         map_data = pyscroll.data.TiledMapData(tmx_data)
 
+        # setup level geometry from the objects in the map.  the collision
+        # grid only checks the walls near a rect, not every wall on the map
+        self.walls = pyscroll.CollisionGrid.from_data(
+            map_data, objects=tmx_data.objects)
+
         w, h = screen.get_size()
 
         # create new renderer (camera)
@@ -193,9 +191,9 @@ class QuestGame(object):
         # check if the sprite's feet are colliding with wall
         # sprite must have a rect called feet, and move_back method,
         # otherwise this will fail
-        for sprite in self.group.sprites():
-            if sprite.feet.collidelist(self.walls) > -1:
-                sprite.move_back(dt)
+        sprites = self.group.sprites()
+        for i in self.walls.collide_many([s.feet for s in sprites]):
+            sprites[i].move_back(dt)
 
     def run(self):
         """ Run the game loop